@@ -0,0 +1,281 @@
+#!/usr/bin/python
+# -*- coding: iso-8859-15 -*-
+'''
+Apply the retention policies to the files of the sdodata latest website: transcode or delete the old files, and keep the disk usage under a quota
+'''
+
+import sys, os, re
+import fnmatch
+import logging
+import argparse
+import subprocess
+from datetime import datetime, timedelta
+
+from make_video import video_to_compact_ts_video, get_video_profile, lossless_video_profile
+from make_latest_videos_and_images import products_by_name, daily_video_pattern, get_frame_date, time_span, latest_video_length, is_provisional
+from make_latest_videos_and_images import scratch_directory, public_directory, scratch_size, scratch_sidecar_suffixes
+from scratch_store import ScratchStore
+
+# Retention policies, applied in order
+#  directory and patterns: the files the policy applies to
+#  age: the policy applies to files older than age, according to the date in their name
+#  action: transcode to replace lossless videos by compact ones, or delete
+#  condition: an optional function of the path and date of the file that must return True for the policy to apply
+retention_policies = [
+	{
+		'name': 'transcode video pieces',
+		'directory': '/data/SDO/public/latest/videos_pieces/',
+		'patterns': ['*.ts'],
+		'age': timedelta(days = 7),
+		'action': 'transcode',
+		'condition': None,
+	},
+	{
+		'name': 'delete video pieces',
+		'directory': '/data/SDO/public/latest/videos_pieces/',
+		'patterns': ['*.ts', '*.frames.txt'],
+		'age': timedelta(days = 30),
+		'action': 'delete',
+		'condition': lambda path, date: daily_video_exists(path, date),
+	},
+	{
+		# Without this, the video pieces whose daily video is never made would be probed by the transcode policy forever
+		'name': 'delete orphan video pieces',
+		'directory': '/data/SDO/public/latest/videos_pieces/',
+		'patterns': ['*.ts', '*.frames.txt'],
+		'age': timedelta(days = 90),
+		'action': 'delete',
+		'condition': None,
+	},
+	{
+		'name': 'delete decimated videos',
+		'directory': '/data/SDO/public/latest/videos_decimated/',
+		'patterns': ['*.ts', '*.frames.txt'],
+		'age': timedelta(hours = max(latest_video_length.values()) + 48),
+		'action': 'delete',
+		'condition': None,
+	},
+	{
+		'name': 'delete archived images',
+		'directory': '/data/SDO/public/latest/images/',
+		'patterns': ['*.quicklook.png', '*.quicklook.webp', '*.quicklook.avif'],
+		'age': timedelta(days = 30),
+		'action': 'delete',
+		'condition': None,
+	},
+	{
+		# The thumbnails tracks of the daily videos point into the sprites, so they are kept as long as the daily videos, that are never deleted
+		'name': 'delete orphan sprites',
+		'directory': '/data/SDO/public/latest/images/',
+		'patterns': ['*.sprite.jpg', '*.sprite.frames.txt'],
+		'age': timedelta(days = 90),
+		'action': 'delete',
+		'condition': lambda path, date: not daily_video_exists(path, date),
+	},
+]
+
+# Max fraction of the disk that can be used, above it the files of the delete policies are deleted whatever their age, oldest first
+disk_quota = 0.9
+
+# Files more recent than this are never deleted because of the disk quota, as the daemon reads them back
+# to make the images and video pieces of the time span, and the decimated videos of the days of the latest videos
+quota_min_age = max(timedelta(hours = time_span), timedelta(days = max(latest_video_length.values()) / 24 + 2))
+
+def get_file_date(path):
+	'''Return the date of a file from its name, or from its directory, or None if unknown'''
+	date = get_frame_date(os.path.basename(path))
+	if date is not None:
+		return date
+	
+	match = re.search(r'(\d{4})/(\d{2})/(\d{2})(?:/H(\d{2})00)?', path)
+	if match is None:
+		return None
+	else:
+		return datetime(*[int(value) for value in match.groups() if value is not None])
+
+def daily_video_exists(path, date):
+	'''Return True if a daily video containing the hour of a video piece exists, and is not provisional as it will be made again from the video pieces'''
+	product_name = os.path.basename(path).split('.')[2]
+	if product_name not in products_by_name:
+		return False
+	
+	# There is one video starting at midnight, and one at noon, each 24 hours long
+	start = date.replace(hour=date.hour - date.hour % 12, minute=0, second=0, microsecond=0)
+	for video_date in (start, start - timedelta(hours = 12)):
+		video_path = daily_video_pattern.format(date=video_date, wavelength=products_by_name[product_name], suffix='mp4')
+		if os.path.exists(video_path) and not is_provisional(video_path):
+			return True
+	
+	return False
+
+def get_policy_files(policy):
+	'''Return the list of (date, path, size) of the files of a policy, oldest first'''
+	files = list()
+	for directory, directory_names, filenames in os.walk(policy['directory']):
+		for filename in filenames:
+			if not any(fnmatch.fnmatch(filename, pattern) for pattern in policy['patterns']):
+				continue
+			path = os.path.join(directory, filename)
+			date = get_file_date(path)
+			if date is None:
+				logging.debug('Unknown date for file %s, skipping!', path)
+				continue
+			try:
+				files.append((date, path, os.path.getsize(path)))
+			except OSError:
+				continue
+	
+	return sorted(files)
+
+def transcode_video(path, dry_run):
+	'''Replace a lossless video by a compact one, return the number of bytes saved'''
+	if get_video_profile(path) != lossless_video_profile:
+		return 0
+	
+	size = os.path.getsize(path)
+	if dry_run:
+		logging.info('Would transcode %s', path)
+		return size
+	
+	directory, filename = os.path.split(path)
+	temp_path = os.path.join(directory, '.' + filename + '.tmp')
+	logging.info('Transcoding %s', path)
+	if video_to_compact_ts_video(path, temp_path):
+		saved = size - os.path.getsize(temp_path)
+		os.rename(temp_path, path)
+		# The lossless copy in the scratch storage of the daemon must not be read instead of the compact video
+		scratch.remove(path)
+		return saved
+	else:
+		logging.error('Error while transcoding %s', path)
+		if os.path.exists(temp_path):
+			os.remove(temp_path)
+		return 0
+
+def delete_file(path, size, dry_run):
+	'''Delete a file, return the number of bytes freed'''
+	if dry_run:
+		logging.info('Would delete %s', path)
+		return size
+	
+	logging.info('Deleting %s', path)
+	try:
+		os.remove(path)
+	except OSError, why:
+		logging.error('Error deleting %s: %s', path, why)
+		return 0
+	else:
+		# The copy in the scratch storage of the daemon must not be found anymore
+		scratch.remove(path)
+		return size
+
+def get_disk_usage(directory):
+	'''Return the used fraction and the total size in bytes of the disk of a directory'''
+	stat = os.statvfs(directory)
+	total = stat.f_blocks * stat.f_frsize
+	free = stat.f_bavail * stat.f_frsize
+	return float(total - free) / total, total
+
+def apply_retention(dry_run = False):
+	'''Apply the retention policies, and return a report as a list of (policy name, number of files, number of bytes)'''
+	now = datetime.utcnow()
+	report = list()
+	
+	for policy in retention_policies:
+		count, size = 0, 0
+		for date, path, file_size in get_policy_files(policy):
+			if date + policy['age'] > now:
+				break
+			
+			if policy['condition'] is not None and not policy['condition'](path, date):
+				continue
+			
+			if policy['action'] == 'transcode':
+				saved = transcode_video(path, dry_run)
+			else:
+				saved = delete_file(path, file_size, dry_run)
+			
+			if saved:
+				count += 1
+				size += saved
+		
+		report.append((policy['name'], count, size))
+	
+	# If the disk is still too full, we delete the oldest files of the delete policies
+	for policy in retention_policies:
+		if policy['action'] != 'delete' or not os.path.isdir(policy['directory']):
+			continue
+		
+		usage, total = get_disk_usage(policy['directory'])
+		if usage <= disk_quota:
+			continue
+		
+		logging.warning('Disk usage of %s is %.1f%%, above the quota of %.1f%%', policy['directory'], usage * 100, disk_quota * 100)
+		to_free = (usage - disk_quota) * total
+		count, size = 0, 0
+		for date, path, file_size in get_policy_files(policy):
+			if size >= to_free or date + quota_min_age > now:
+				break
+			
+			if policy['condition'] is not None and not policy['condition'](path, date):
+				continue
+			
+			freed = delete_file(path, file_size, dry_run)
+			if freed:
+				count += 1
+				size += freed
+		
+		report.append((policy['name'] + ' (disk quota)', count, size))
+	
+	return report
+
+def set_low_priority():
+	'''Lower the cpu and io priority of the process, so that it does not slow down the daemon'''
+	try:
+		os.nice(19)
+	except OSError, why:
+		logging.warning('Could not lower the cpu priority: %s', why)
+	
+	try:
+		subprocess.call(['ionice', '-c', '3', '-p', str(os.getpid())])
+	except OSError, why:
+		logging.warning('Could not lower the io priority: %s', why)
+
+
+if __name__ == '__main__':
+	
+	# Default name for the log file
+	log_filename = os.path.splitext(sys.argv[0])[0] + '.log'
+	
+	# Get the arguments
+	parser = argparse.ArgumentParser(description='Apply the retention policies to the AIA latest images and videos')
+	parser.add_argument('--debug', '-d', default=False, action='store_true', help='Set the logging level to debug')
+	parser.add_argument('--verbose', '-v', default=False, action='store_true', help='Set the logging level to info')
+	parser.add_argument('--log_filename', '-l', default=log_filename, help='The path of the log file')
+	parser.add_argument('--dry_run', '-n', default=False, action='store_true', help='Do not change any file, only report what would be done')
+	parser.add_argument('--low_priority', '-p', default=False, action='store_true', help='Run with the lowest cpu and io priority')
+	parser.add_argument('--scratch_directory', '-s', default=scratch_directory, help='Local directory of the daemon where the copies of the deleted files are deleted too')
+	
+	# Parse the arguments
+	args = parser.parse_args()
+	
+	if args.debug:
+		log_level = logging.DEBUG
+	elif args.verbose:
+		log_level = logging.INFO
+	else:
+		log_level = logging.ERROR
+	
+	# Setup the logging
+	logging.basicConfig(level = log_level, filename = args.log_filename, format='%(asctime)s %(levelname)-8s %(funcName)-12s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+	
+	if args.low_priority:
+		set_low_priority()
+	
+	scratch = ScratchStore(args.scratch_directory, public_directory, scratch_size, sidecar_suffixes = scratch_sidecar_suffixes)
+	
+	report = apply_retention(args.dry_run)
+	
+	# Print the report
+	for name, count, size in report:
+		print '%s: %d files, %.1f MB %s' % (name, count, size / (1024. * 1024.), 'would be freed' if args.dry_run else 'freed')
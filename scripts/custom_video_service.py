@@ -0,0 +1,337 @@
+#!/usr/bin/python
+# -*- coding: iso-8859-15 -*-
+'''
+HTTP service to make videos of a custom time range from the video pieces of the sdodata latest website
+'''
+
+import sys, os, glob
+import logging
+import argparse
+import shutil
+import tempfile
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from datetime import timedelta
+from dateutil.parser import parse as parse_date
+from dateutil.tz import tzutc
+
+from make_video import video_to_ts_video, video_frames_to_ts_video, video_to_mp4_video, video_to_compact_ts_video, get_video_profile, lossless_video_profile
+from make_latest_videos_and_images import products_by_name, video_piece_pattern, video_frame_rate, make_directory, round_to_hour, get_frame_date, read_video_piece_frames, get_video_piece_frames_path
+from make_latest_videos_and_images import scratch_directory, public_directory, scratch_size
+from scratch_store import ScratchStore
+
+# Address and port of the service
+service_address = ''
+service_port = 8080
+
+# Max number of concurrent video encodings
+max_encodings = 2
+
+# Max duration of a custom video
+max_video_length = timedelta(days = 2)
+
+# Preset of the encoding of the mp4 videos, favoring the response time over the size of the video
+# The mp4 videos are always reencoded to the baseline profile that all browsers play, the ts videos are copied from the video pieces if they are all lossless
+# The video pieces older than a week are transcoded by the retention to compact videos, that cannot be copied together with the lossless ones
+video_preset = 'veryfast'
+
+# Directory of the cached custom videos and the corresponding url
+cache_directory = '/data/SDO/public/latest/videos/custom/'
+cache_url = '/latest/videos/custom/'
+
+# Max size of the cached custom videos in bytes
+cache_size = 50 * 1024 * 1024 * 1024
+
+# Name of the custom videos
+custom_video_pattern = 'AIA.{start.year:04d}{start.month:02d}{start.day:02d}_{start.hour:02d}{start.minute:02d}{start.second:02d}_{end.year:04d}{end.month:02d}{end.day:02d}_{end.hour:02d}{end.minute:02d}{end.second:02d}.{wavelength:04d}.quicklook.{suffix}'
+
+# Content types of the custom videos
+video_content_types = {
+	'mp4': 'video/mp4',
+	'ts': 'video/mp2t',
+}
+
+class VideoCache(object):
+	'''Size bounded cache of the custom videos on disk, where the least recently used videos are removed first'''
+	
+	def __init__(self, directory, size):
+		self.directory = directory
+		self.size = size
+		self.lock = threading.Lock()
+		self.encodings = threading.Semaphore(max_encodings)
+		self.pending = dict()
+	
+	def get(self, wavelength, start, end, suffix):
+		'''Return the path of the custom video, making it if necessary, or None if it could not be made'''
+		video_path = os.path.join(self.directory, custom_video_pattern.format(wavelength=wavelength, start=start, end=end, suffix=suffix))
+		video_pieces = get_video_pieces(wavelength, start, end)
+		
+		self.lock.acquire()
+		
+		# If the video is cached and up to date, we mark it as recently used
+		if os.path.exists(video_path) and not is_outdated(video_path, video_pieces):
+			self.lock.release()
+			logging.debug('Custom video %s found in cache', video_path)
+			try:
+				os.utime(video_path, None)
+			except OSError, why:
+				logging.warning('Could not update the time of custom video %s: %s', video_path, why)
+			return video_path
+		
+		# If the same video is already being made, we wait for it
+		if video_path in self.pending:
+			event = self.pending[video_path]
+			self.lock.release()
+			logging.debug('Custom video %s is already being made, waiting', video_path)
+			event.wait()
+			return video_path if os.path.exists(video_path) else None
+		
+		event = threading.Event()
+		self.pending[video_path] = event
+		self.lock.release()
+		
+		try:
+			with self.encodings:
+				success = make_custom_video(wavelength, start, end, video_pieces, video_path)
+		finally:
+			self.lock.acquire()
+			del self.pending[video_path]
+			self.lock.release()
+			event.set()
+		
+		if success:
+			self.clean()
+			return video_path
+		else:
+			return None
+	
+	def clean(self):
+		'''Remove the least recently used videos until the cache fits in its size'''
+		videos = list()
+		for video_path in glob.glob(os.path.join(self.directory, 'AIA.*.quicklook.*')):
+			try:
+				stat = os.stat(video_path)
+			except OSError:
+				continue
+			videos.append((stat.st_mtime, stat.st_size, video_path))
+		
+		total_size = sum(size for mtime, size, video_path in videos)
+		for mtime, size, video_path in sorted(videos):
+			if total_size <= self.size:
+				break
+			logging.info('Removing custom video %s from cache', video_path)
+			try:
+				os.remove(video_path)
+			except OSError, why:
+				logging.error('Could not remove custom video %s: %s', video_path, why)
+			else:
+				total_size -= size
+
+
+def get_video_pieces(wavelength, start, end):
+	'''Return the list of the video pieces of the hours of the time range that exist'''
+	video_pieces = list()
+	
+	for hours in range(int((round_to_hour(end) - round_to_hour(start)).total_seconds() / 3600) + 1):
+		video_piece = scratch.find(video_piece_pattern.format(date = round_to_hour(start) + timedelta(hours = hours), wavelength = wavelength))
+		if os.path.exists(video_piece):
+			video_pieces.append(video_piece)
+		else:
+			logging.warning('Video piece %s not found, skipping!', video_piece)
+	
+	return video_pieces
+
+
+def is_outdated(video_path, video_pieces):
+	'''Return True if a video piece or its list of frames changed or appeared since the custom video was made, like the piece of the current hour that is still growing'''
+	try:
+		video_time = os.path.getmtime(video_path)
+	except OSError:
+		return True
+	
+	for video_piece in video_pieces:
+		for path in (video_piece, get_video_piece_frames_path(video_piece)):
+			try:
+				if os.path.getmtime(path) > video_time:
+					logging.debug('Custom video %s is older than %s', video_path, path)
+					return True
+			except OSError:
+				continue
+	
+	return False
+
+
+def get_video_parts(video_pieces, start, end, temp_directory):
+	'''Return the list of videos covering the time range, trimming the video pieces at the edges'''
+	video_parts = list()
+	
+	for video_piece in video_pieces:
+		frames = read_video_piece_frames(video_piece)
+		if not frames:
+			logging.warning('Frames of video piece %s are unknown, using the whole video piece', video_piece)
+			video_parts.append(video_piece)
+			continue
+		
+		# We search the frames in the time range
+		frame_numbers = list()
+		for frame_number, frame in enumerate(frames):
+			frame_date = get_frame_date(frame)
+			if frame_date is None or start <= frame_date <= end:
+				frame_numbers.append(frame_number)
+		
+		if not frame_numbers:
+			logging.debug('No frame of video piece %s in the time range', video_piece)
+		
+		# If all frames are needed, the video piece can be used as is
+		elif len(frame_numbers) == len(frames):
+			video_parts.append(video_piece)
+		
+		else:
+			video_part = os.path.join(temp_directory, os.path.basename(video_piece))
+			if video_frames_to_ts_video(video_piece, video_part, frame_numbers[0], frame_numbers[-1], frame_rate = video_frame_rate):
+				video_parts.append(video_part)
+			else:
+				logging.error('Error while trimming video piece %s', video_piece)
+				return None
+	
+	return video_parts
+
+
+def make_custom_video(wavelength, start, end, video_pieces, video_path):
+	
+	make_directory(os.path.dirname(video_path))
+	temp_directory = tempfile.mkdtemp(dir = os.path.dirname(video_path))
+	
+	try:
+		video_parts = get_video_parts(video_pieces, start, end, temp_directory)
+		
+		if not video_parts:
+			logging.warning('No video pieces found to make custom video %s', video_path)
+			return False
+		
+		# Make the video to a temp path as not to serve a partial video
+		video_name, video_extension = os.path.splitext(os.path.basename(video_path))
+		temp_video_path = os.path.join(temp_directory, video_name + '.tmp' + video_extension)
+		
+		logging.info('Making custom video %s from %d video pieces', video_path, len(video_parts))
+		
+		# The ts videos are concatenated without reencoding when the video pieces are all lossless, the mp4 videos are reencoded for the browsers
+		if video_extension == '.ts':
+			if all(get_video_profile(video_piece) == lossless_video_profile for video_piece in video_pieces):
+				success = video_to_ts_video(video_parts, temp_video_path)
+			else:
+				logging.info('Some video pieces of custom video %s are not lossless, reencoding them', video_path)
+				success = video_to_compact_ts_video(video_parts, temp_video_path, video_preset = video_preset)
+		else:
+			video_title = 'Video of AIA {wavelength}Å from {start} to {end}'.format(wavelength = wavelength, start=start.isoformat(), end=end.isoformat())
+			success = video_to_mp4_video(video_parts, temp_video_path, video_frame_rate, video_title, video_preset = video_preset)
+		
+		if success:
+			logging.debug('Moving file %s to %s', temp_video_path, video_path)
+			shutil.move(temp_video_path, video_path)
+		else:
+			logging.error('Error while making custom video %s', video_path)
+		
+		return success
+	
+	finally:
+		shutil.rmtree(temp_directory, ignore_errors = True)
+
+
+def to_utc(date):
+	'''Return a date as a naive UTC date like the dates of the frames, converting it if it has a timezone'''
+	if date.tzinfo is None:
+		return date
+	else:
+		return date.astimezone(tzutc()).replace(tzinfo = None)
+
+
+class CustomVideoRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	'''Handle requests like /?wavelength=131&start=2016-10-19T13:20&end=2016-10-19T17:45&format=mp4 by redirecting to the custom video'''
+	
+	def do_GET(self):
+		query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+		
+		try:
+			wavelength = query['wavelength'][0]
+			start = to_utc(parse_date(query['start'][0]))
+			end = to_utc(parse_date(query['end'][0]))
+			suffix = query.get('format', ['mp4'])[0]
+		except Exception, why:
+			self.send_error(400, 'Parameters wavelength, start and end are mandatory and must be valid: %s' % why)
+			return
+		
+		# The wavelength can be given as a number, or as the name of a product
+		if wavelength.isdigit():
+			wavelength = '%04d' % int(wavelength)
+		
+		if wavelength not in products_by_name:
+			self.send_error(400, 'Unknown wavelength %s' % wavelength)
+		elif suffix not in video_content_types:
+			self.send_error(400, 'Unknown format %s, must be one of %s' % (suffix, ', '.join(video_content_types)))
+		elif end <= start:
+			self.send_error(400, 'End must be after start')
+		elif end - start > max_video_length:
+			self.send_error(400, 'Time range must be shorter than %s' % max_video_length)
+		else:
+			video_path = video_cache.get(products_by_name[wavelength], start, end, suffix)
+			if video_path is None:
+				self.send_error(404, 'No video could be made for wavelength %s from %s to %s' % (wavelength, start, end))
+			else:
+				self.send_response(302)
+				self.send_header('Location', cache_url + os.path.basename(video_path))
+				self.send_header('Content-Type', video_content_types[suffix])
+				self.end_headers()
+	
+	def log_message(self, format, *args):
+		logging.info('%s %s', self.address_string(), format % args)
+
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+
+if __name__ == '__main__':
+	
+	# Default name for the log file
+	log_filename = os.path.splitext(sys.argv[0])[0] + '.log'
+	
+	# Get the arguments
+	parser = argparse.ArgumentParser(description='Serve AIA videos of a custom time range')
+	parser.add_argument('--debug', '-d', default=False, action='store_true', help='Set the logging level to debug')
+	parser.add_argument('--verbose', '-v', default=False, action='store_true', help='Set the logging level to info')
+	parser.add_argument('--log_filename', '-l', default=log_filename, help='The path of the log file')
+	parser.add_argument('--port', '-p', default=service_port, type=int, help='The port to listen to')
+	parser.add_argument('--cache_size', '-s', default=cache_size, type=int, help='Max size of the cached custom videos in bytes')
+	parser.add_argument('--scratch_directory', default=scratch_directory, help='Local directory of the daemon where the video pieces are read first')
+	
+	# Parse the arguments
+	args = parser.parse_args()
+	
+	if args.debug:
+		log_level = logging.DEBUG
+	elif args.verbose:
+		log_level = logging.INFO
+	else:
+		log_level = logging.ERROR
+	
+	# Setup the logging
+	logging.basicConfig(level = log_level, filename = args.log_filename, format='%(asctime)s %(levelname)-8s %(funcName)-12s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+	
+	video_cache = VideoCache(cache_directory, args.cache_size)
+	
+	# The video pieces are read from the local storage of the daemon when they are there, it is cleaned by the daemon only
+	scratch = ScratchStore(args.scratch_directory, public_directory, scratch_size)
+	
+	server = ThreadedHTTPServer((service_address, args.port), CustomVideoRequestHandler)
+	
+	logging.info('Starting custom video service on port %s', args.port)
+	
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		logging.info('Received keyboard interrupt: Exiting gracefully')
+	finally:
+		server.server_close()
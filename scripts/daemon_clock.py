@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-15 -*-
+import time
+from datetime import datetime, timedelta
+
+class Clock(object):
+	'''The clock of the daemon, that gives the current time and waits'''
+	
+	def utcnow(self):
+		return datetime.utcnow()
+	
+	def now(self):
+		return datetime.now()
+	
+	def sleep(self, seconds):
+		time.sleep(seconds)
+
+
+class AcceleratedClock(Clock):
+	'''A clock that starts at a simulated date and runs speedup times faster than the real time'''
+	
+	def __init__(self, start, speedup = 60.):
+		self.start = start
+		self.speedup = speedup
+		self.real_start = time.time()
+		# The local time keeps the same offset to the UTC time as the real clock
+		self.utc_offset = timedelta(minutes = round((datetime.now() - datetime.utcnow()).total_seconds() / 60.))
+	
+	def utcnow(self):
+		return self.start + timedelta(seconds = (time.time() - self.real_start) * self.speedup)
+	
+	def now(self):
+		return self.utcnow() + self.utc_offset
+	
+	def sleep(self, seconds):
+		'''Wait for a duration of simulated time'''
+		time.sleep(seconds / self.speedup)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-15 -*-
+import threading
+import numpy
+
+class Composite(object):
+	'''A product made by blending the frames of several wavelengths taken at about the same time'''
+	
+	def __init__(self, name, wavelengths, blend):
+		self.name = name
+		self.wavelengths = wavelengths
+		self.blend = blend
+	
+	def __format__(self, format_spec):
+		# The composite is formatted by its name in the paths, where a wavelength would be
+		return self.name
+	
+	def __str__(self):
+		return self.name
+	
+	def __repr__(self):
+		return 'Composite(%s)' % self.name
+
+
+class FrameMatcher(object):
+	'''Match by date the frames of the wavelengths of composite products, so that each frame is decoded only once whatever the number of products using it'''
+	
+	def __init__(self, composites, max_time_difference, max_age):
+		self.lock = threading.Lock()
+		self.composites = composites
+		self.max_time_difference = max_time_difference
+		self.max_age = max_age
+		self.frames = dict((wavelength, dict()) for composite in composites for wavelength in composite.wavelengths)
+		self.matched = dict()
+		self.latest_date = None
+	
+	@property
+	def wavelengths(self):
+		return self.frames.keys()
+	
+	def add(self, wavelength, date, frame):
+		'''Add the frame of a wavelength, and return the list of (composite, date, frames) that can now be made'''
+		matches = list()
+		
+		self.lock.acquire()
+		
+		self.frames[wavelength][date] = frame
+		
+		for composite in self.composites:
+			if wavelength not in composite.wavelengths:
+				continue
+			
+			frames = list()
+			for composite_wavelength in composite.wavelengths:
+				frame_date = date if composite_wavelength == wavelength else self.get_closest_date(composite_wavelength, date)
+				if frame_date is None:
+					break
+				frames.append((frame_date, self.frames[composite_wavelength][frame_date]))
+			else:
+				# The date of the composite is the date of the frame of its first wavelength
+				composite_date = frames[0][0]
+				if (composite, composite_date) not in self.matched:
+					self.matched[(composite, composite_date)] = composite_date
+					matches.append((composite, composite_date, [frame for frame_date, frame in frames]))
+		
+		if self.latest_date is None or date > self.latest_date:
+			self.latest_date = date
+		
+		self.clean()
+		
+		self.lock.release()
+		
+		return matches
+	
+	def get_closest_date(self, wavelength, date):
+		'''Return the date of the frame of a wavelength closest to date, or None if none is close enough'''
+		frame_dates = [frame_date for frame_date in self.frames[wavelength] if abs(frame_date - date) <= self.max_time_difference]
+		if frame_dates:
+			return min(frame_dates, key = lambda frame_date: abs(frame_date - date))
+		else:
+			return None
+	
+	def clean(self):
+		'''Drop the frames that are too old to still be matched, so that memory stays bounded'''
+		oldest_date = self.latest_date - self.max_age
+		for frames in self.frames.values():
+			for frame_date in [frame_date for frame_date in frames if frame_date < oldest_date]:
+				del frames[frame_date]
+		for key in [key for key, composite_date in self.matched.iteritems() if composite_date < oldest_date]:
+			del self.matched[key]
+
+
+def blend_rgb(frames):
+	'''Use the frames of the wavelengths as the red, green and blue channels'''
+	return numpy.dstack(frames)
+
+
+def blend_overlay(frames):
+	'''Overlay the frame of the first wavelength in red and the frame of the second wavelength in blue'''
+	first_frame, second_frame = frames
+	mean_frame = ((first_frame.astype(numpy.uint16) + second_frame) / 2).astype(numpy.uint8)
+	return numpy.dstack((first_frame, mean_frame, second_frame))
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-15 -*-
+import threading
+import heapq
+import itertools
+import collections
+from datetime import timedelta
+import numpy
+
+class Difference(object):
+	'''A product made by subtracting from each frame of a wavelength a reference frame
+	For a running difference, the reference is the frame taken lag before
+	For a base difference, the reference is the first frame of the hour'''
+	
+	def __init__(self, name, wavelength, mode = 'running', lag = timedelta(minutes = 2)):
+		self.name = name
+		self.wavelength = wavelength
+		self.mode = mode
+		self.lag = lag
+	
+	def __format__(self, format_spec):
+		# The difference is formatted by its name in the paths, where a wavelength would be
+		return self.name
+	
+	def __str__(self):
+		return self.name
+	
+	def __repr__(self):
+		return 'Difference(%s)' % self.name
+
+
+class FrameRingBuffer(object):
+	'''Keep in memory the last frames of a wavelength ordered by date
+	Frames are released in chronological order once no earlier frame is expected anymore'''
+	
+	def __init__(self, size, reorder_delay):
+		self.frames = collections.deque(maxlen = size)
+		self.reorder_delay = reorder_delay
+		self.pending = list()
+		self.counter = itertools.count()
+	
+	def add(self, date, frame):
+		'''Add a frame to be released, return False if the frame is older than the frames already released'''
+		if self.frames and date <= self.frames[-1][0]:
+			return False
+		
+		heapq.heappush(self.pending, (date, next(self.counter), frame))
+		return True
+	
+	def release(self, flush = False):
+		'''Return the list of (date, frame) that are older than the latest frame by more than the reorder delay (or all if flush), in chronological order'''
+		released = list()
+		
+		if self.pending:
+			latest_date = max(date for date, count, frame in self.pending)
+			while self.pending and (flush or self.pending[0][0] <= latest_date - self.reorder_delay):
+				date, count, frame = heapq.heappop(self.pending)
+				released.append((date, frame))
+		
+		return released
+	
+	def append(self, date, frame):
+		'''Add a released frame to the ring, dropping the oldest one if it is full'''
+		self.frames.append((date, frame))
+	
+	def get_closest(self, date, max_time_difference):
+		'''Return the frame of the ring closest to date, or None if none is close enough'''
+		closest = None
+		for frame_date, frame in self.frames:
+			if abs(frame_date - date) <= max_time_difference and (closest is None or abs(frame_date - date) < abs(closest[0] - date)):
+				closest = (frame_date, frame)
+		
+		return closest[1] if closest else None
+
+
+class DifferenceMaker(object):
+	'''Make the frames of the difference products from the frames of their wavelength, keeping only a bounded number of frames in memory'''
+	
+	def __init__(self, differences, buffer_size, reorder_delay, max_time_difference, clip_sigma = 5.):
+		self.differences = differences
+		self.max_time_difference = max_time_difference
+		self.clip_sigma = clip_sigma
+		self.buffers = dict((difference.wavelength, FrameRingBuffer(buffer_size, reorder_delay)) for difference in differences)
+		self.bases = dict()
+		self.lock = threading.Lock()
+	
+	@property
+	def wavelengths(self):
+		return self.buffers.keys()
+	
+	def add(self, wavelength, date, frame):
+		'''Add the frame of a wavelength, and return the list of (difference, date, frame) that can now be made, in chronological order'''
+		buffer = self.buffers[wavelength]
+		
+		self.lock.acquire()
+		try:
+			return self.make_differences(buffer, wavelength, date, frame)
+		finally:
+			self.lock.release()
+	
+	def make_differences(self, buffer, wavelength, date, frame):
+		if not buffer.add(date, frame):
+			return []
+		
+		results = list()
+		for frame_date, frame in buffer.release():
+			for difference in self.differences:
+				if difference.wavelength != wavelength:
+					continue
+				
+				if difference.mode == 'base':
+					hour = frame_date.replace(minute=0, second=0, microsecond=0)
+					if difference not in self.bases or self.bases[difference][0] != hour:
+						self.bases[difference] = (hour, frame)
+					reference_frame = self.bases[difference][1]
+				else:
+					reference_frame = buffer.get_closest(frame_date - difference.lag, self.max_time_difference)
+				
+				if reference_frame is not None:
+					results.append((difference, frame_date, difference_frame(frame, reference_frame, self.clip_sigma)))
+			
+			buffer.append(frame_date, frame)
+		
+		return results
+
+
+def difference_frame(frame, reference_frame, clip_sigma = 5.):
+	'''Return the difference of 2 frames as bytes, where no difference is 128, and the differences are clipped at clip_sigma times a robust estimate of their standard deviation'''
+	difference = frame.astype(numpy.int16) - reference_frame
+	
+	# The median absolute deviation is estimated on a subsample of the pixels, for speed
+	sigma = 1.4826 * numpy.median(numpy.abs(difference[::4, ::4]))
+	scale = 127. / max(clip_sigma * sigma, 1.)
+	
+	return numpy.clip(difference * scale + 128, 0, 255).astype(numpy.uint8)
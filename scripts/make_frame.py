@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-15 -*-
+import numpy
+import pyfits
+
+# Scaling of the AIA frames per wavelength: the function, and the min and max of the intensity per second of exposure
+# Values are taken from the aia_intscale procedure of SolarSoft
+aia_scaling = {
+	94: ('sqrt', 1.5, 50.),
+	131: ('log', 7., 1200.),
+	171: ('sqrt', 10., 6000.),
+	193: ('log', 120., 6000.),
+	211: ('log', 30., 13000.),
+	304: ('log', 15., 600.),
+	335: ('log', 3.5, 1000.),
+	1600: ('linear', 0., 1000.),
+	1700: ('linear', 0., 2500.),
+	4500: ('linear', 0., 26000.),
+}
+
+def read_frame(fitsfile):
+	'''Return the image data and the header of the first hdu of a fits file that contains an image'''
+	hdulist = pyfits.open(fitsfile, memmap = False)
+	try:
+		for hdu in hdulist:
+			if hdu.data is not None:
+				return hdu.data, hdu.header
+	finally:
+		hdulist.close()
+	
+	raise ValueError('No image found in fits file %s' % fitsfile)
+
+
+def scale_frame(data, header, wavelength):
+	'''Return the frame as bytes, normalised by the exposure time, scaled, recentered and oriented like the png images'''
+	function, min_value, max_value = aia_scaling[wavelength]
+	
+	frame = data.astype(numpy.float32)
+	
+	exposure_time = header.get('EXPTIME', 0)
+	if exposure_time > 0:
+		frame /= exposure_time
+	
+	numpy.clip(frame, max(min_value, 1e-3), max_value, out = frame)
+	
+	if function == 'log':
+		frame = numpy.log10(frame / max(min_value, 1e-3)) / numpy.log10(max_value / max(min_value, 1e-3))
+	elif function == 'sqrt':
+		frame = numpy.sqrt((frame - min_value) / (max_value - min_value))
+	else:
+		frame = (frame - min_value) / (max_value - min_value)
+	
+	frame = numpy.clip(frame * 255, 0, 255).astype(numpy.uint8)
+	
+	# Recenter the sun in the middle of the frame, like fits2png
+	if 'CRPIX1' in header and 'CRPIX2' in header:
+		height, width = frame.shape
+		frame = numpy.roll(frame, int(round((width + 1) / 2. - header['CRPIX1'])), axis = 1)
+		frame = numpy.roll(frame, int(round((height + 1) / 2. - header['CRPIX2'])), axis = 0)
+	
+	# The first row of a fits image is the bottom of the image
+	return numpy.ascontiguousarray(numpy.flipud(frame))
+
+
+def get_aia_color_table(wavelength):
+	'''Return the color table of a wavelength as an array of 256 rgb colors, approximating the aia_lct procedure of SolarSoft'''
+	c0 = numpy.arange(256, dtype = numpy.float32)
+	c1 = numpy.sqrt(c0) * numpy.sqrt(255.)
+	c2 = c0 ** 2 / 255.
+	c3 = (c1 + c2 / 2.) * 255. / (c1.max() + c2.max() / 2.)
+	
+	# Approximation of the red temperature color table of IDL
+	r0 = c0 * 255. / 176.
+	g0 = (c0 - 120.) * 255. / 135.
+	b0 = (c0 - 190.) * 255. / 65.
+	
+	color_tables = {
+		94: (c2, c3, c0),
+		131: (g0, r0, r0),
+		171: (r0, c0, b0),
+		193: (c1, c0, c2),
+		211: (c1, c0, c3),
+		304: (r0, g0, b0),
+		335: (c2, c0, c1),
+		1600: (c3, c3, c2),
+		1700: (c1, c0, c0),
+		4500: (c0, c0, b0 / 2.),
+	}
+	
+	return numpy.clip(numpy.column_stack(color_tables[wavelength]), 0, 255).astype(numpy.uint8)
+
+# The color tables are computed only once
+aia_color_tables = dict((wavelength, get_aia_color_table(wavelength)) for wavelength in aia_scaling)
+
+def colorize_frame(frame, wavelength):
+	'''Return the frame as rgb bytes, colored with the color table of its wavelength'''
+	return aia_color_tables[wavelength][frame]
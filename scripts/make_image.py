@@ -5,7 +5,7 @@ import os
 import argparse
 import logging
 
-from run_command import run_command
+from run_command import run_command, run_command_with_input_data
 
 
 # Path to the fits2png.x executable from the SPoCA software suite
@@ -14,6 +14,14 @@ fits2png_bin = '/home/sdo/SPoCA/bin/fits2png.x'
 # Path to the convert executable from the ImageMagick software suite
 convert_bin = 'convert'
 
+# Encoding options of convert for each image format
+image_format_options = {
+	'png': [],
+	'jpg': ['-background', 'black', '-flatten', '-interlace', 'Plane', '-quality', '85', '-strip'],
+	'webp': ['-quality', '80', '-define', 'webp:method=6', '-strip'],
+	'avif': ['-quality', '50', '-strip'],
+}
+
 def fits_to_png(input_filename, output_directory, size=None):
 	# We set up fits2png for the creation of the png
 	fits2png = [fits2png_bin, input_filename, '-u', '-R', '512.5,512.5', '-L', '-c']
@@ -39,6 +47,51 @@ def image_to_button(input_filename, output_filename, size):
 	return run_command(convert)
 
 
+def image_to_formats(input_filename, output_filenames, size=None, transparent=False):
+	# We set up convert so that the input image is decoded, resized and made transparent only once
+	convert = [convert_bin, input_filename]
+	
+	if size:
+		convert.extend(['-resize', size])
+	
+	if transparent:
+		convert.extend(['-fuzz', '10%', '-transparent', 'black'])
+	
+	convert.extend(get_outputs_options(output_filenames))
+	
+	return run_command(convert)
+
+
+def raw_to_png(input_data, width, height, output_filename, pixel_format = 'rgb'):
+	# We set up convert for the creation of a png from raw bytes on the standard input (pixel format is gray or rgb)
+	convert = [convert_bin, '-size', '%dx%d' % (width, height), '-depth', '8', pixel_format + ':-', output_filename]
+	
+	return run_command_with_input_data(convert, input_data)
+
+
+def raw_to_formats(input_data, width, height, output_filenames, pixel_format = 'rgb'):
+	# We set up convert so that the raw bytes on the standard input are read only once for all the formats (pixel format is gray or rgb)
+	convert = [convert_bin, '-size', '%dx%d' % (width, height), '-depth', '8', pixel_format + ':-'] + get_outputs_options(output_filenames)
+	
+	return run_command_with_input_data(convert, input_data)
+
+
+def get_format_options(filename):
+	image_format = os.path.splitext(filename)[1].lstrip('.').lower()
+	return image_format_options.get(image_format, [])
+
+
+def get_outputs_options(output_filenames):
+	# Each output but the last is written from a clone of the image, so that format options do not leak to the next one
+	options = list()
+	for output_filename in output_filenames[:-1]:
+		options.extend(['(', '+clone'] + get_format_options(output_filename) + ['-write', output_filename, '+delete', ')'])
+	
+	options.extend(get_format_options(output_filenames[-1]) + [output_filenames[-1]])
+	
+	return options
+
+
 # Start point of the script
 if __name__ == '__main__':
 	
@@ -4,20 +4,26 @@
 Deamon to generate images and videos from aia quicklook fits files for the sdodata latest website
 '''
 
-import sys, os, errno, glob
+import sys, os, errno, glob, re
 import logging
 import argparse
 import shutil
 import signal
-from time import sleep
 from datetime import time, datetime, timedelta
 from dateutil.parser import parse as parse_date
 import threading
+import subprocess
+import bisect
 import Queue
 import pyfits
 
-from make_video import png_to_ts_video, video_to_mp4_video
-from make_image import fits_to_png, image_to_thumbnail, image_to_button
+from make_video import png_to_ts_video, video_to_mp4_video_chunked, raw_to_ts_video_encoder, video_select_frames_to_ts_video, video_frames_to_ts_video, video_frames_to_sprite
+from make_image import fits_to_png, image_to_formats, raw_to_png, raw_to_formats
+from make_frame import read_frame, scale_frame, colorize_frame
+from make_composite import Composite, FrameMatcher, blend_rgb, blend_overlay
+from make_difference import Difference, DifferenceMaker, FrameRingBuffer
+from scratch_store import ScratchStore
+from daemon_clock import Clock
 
 # Max number of concurrent threads
 max_threads = 5
@@ -30,8 +36,12 @@ max_run_frequency = {
 	'make_images': timedelta(minutes = 5),
 	'make_latest_images': timedelta(minutes = 5),
 	'make_video_pieces': timedelta(minutes = 10),
+	'make_sprites': timedelta(minutes = 10),
+	'make_decimated_videos': timedelta(minutes = 10),
 	'make_latest_videos': timedelta(minutes = 10),
 	'make_daily_videos': timedelta(hours = 12),
+	'apply_retention': timedelta(hours = 6),
+	'restore_provisional_videos': timedelta(hours = 1),
 }
 
 # Min acceptable AIA quality bits (See AIA/SDO keywords)
@@ -40,30 +50,148 @@ AIA_min_quality = (1 << 2) + (1 << 8) + (1 << 9) + (1 << 13) + (1 << 30)
 # AIA Fits files wavelengths
 AIA_wavelengths = [94, 131, 171, 193, 211, 304, 335, 1600, 1700, 4500]
 
+# Composite products made by blending the images of several wavelengths taken at about the same time
+composite_products = [
+	Composite('0211_0193_0171_rgb', [211, 193, 171], blend_rgb),
+	Composite('0094_0335_overlay', [94, 335], blend_overlay),
+]
+
+# Max time difference between the images of a composite product
+composite_max_time_difference = timedelta(seconds = 30)
+
+# Max time to keep an image in memory waiting for the images of the other wavelengths of a composite product
+composite_max_age = timedelta(minutes = 10)
+
+# Difference products made by subtracting from each image of a wavelength an earlier image
+difference_products = [
+	Difference('0193_running_difference', 193, 'running', timedelta(minutes = 2)),
+	Difference('0211_base_difference', 211, 'base'),
+]
+
+# Number of images per wavelength kept in memory to make the difference products
+difference_buffer_size = 20
+
+# Time to wait for images arriving out of order before making the difference products
+difference_reorder_delay = timedelta(minutes = 1)
+
+# Max time difference between the image taken lag before and the reference image of a running difference
+difference_max_time_difference = timedelta(seconds = 30)
+
+# Products for which images are made, the composite products are handled like extra wavelengths
+image_products = AIA_wavelengths + composite_products
+
+# All the products for which videos are made, the video pieces of the difference products are made directly from the decoded images
+products = image_products + difference_products
+
+# Products by their name in the paths, like 0131 or 0211_0193_0171_rgb
+products_by_name = dict(('{product:04d}'.format(product=product), product) for product in products)
+
 # Paths of the fits files
 fitsfiles_directory = '/data/SDO/public/AIA_quicklook/{wavelength:04d}/{date.year:04d}/{date.month:02d}/{date.day:02d}/H{date.hour:02d}00/'
 
 # Paths of the images
 images_directory_pattern = '/data/SDO/public/latest/images/{date.year:04d}/{date.month:02d}/{date.day:02d}/H{date.hour:02d}00/'
+composite_image_pattern = 'AIA.{date.year:04d}{date.month:02d}{date.day:02d}_{date.hour:02d}{date.minute:02d}{date.second:02d}.{wavelength:04d}.quicklook.png'
 latest_image_pattern = '/data/SDO/public/latest/images/latest/AIA.latest.{wavelength:04d}.quicklook.{suffix}'
+sprite_pattern = 'AIA.{date.year:04d}{date.month:02d}{date.day:02d}_{date.hour:02d}0000.{wavelength:04d}.quicklook.sprite.jpg'
 
 # Paths of the videos
 video_piece_pattern = '/data/SDO/public/latest/videos_pieces/{date.year:04d}/{date.month:02d}/{date.day:02d}/H{date.hour:02d}00/AIA.{date.year:04d}{date.month:02d}{date.day:02d}_{date.hour:02d}0000.{wavelength:04d}.quicklook.ts'
 daily_video_pattern = '/data/SDO/public/latest/videos/{date.year:04d}/{date.month:02d}/{date.day:02d}/AIA.{date.year:04d}{date.month:02d}{date.day:02d}_{date.hour:02d}0000.{wavelength:04d}.quicklook.{suffix}'
 latest_video_pattern = '/data/SDO/public/latest/videos/latest/AIA.latest.{wavelength:04d}.quicklook.{suffix}'
+decimated_video_pattern = '/data/SDO/public/latest/videos_decimated/{date.year:04d}/{date.month:02d}/{date.day:02d}/AIA.{date.year:04d}{date.month:02d}{date.day:02d}_000000.{wavelength:04d}.{cadence:d}s.quicklook.ts'
+
+# Local directory (on a local disk or a tmpfs) where the intermediate files are made and read back before being published to the public directory
+# If None, the files are made directly in the public directory
+scratch_directory = None
+public_directory = '/data/SDO/public/latest/'
+
+# URL of the public directory on the website
+public_url = '/latest/'
+
+# Max size in bytes of the scratch directory, the least recently used files are removed first
+scratch_size = 100 * 1024 * 1024 * 1024
+
+# Files that stay in the scratch directory while they are recent, because they are read back to make the videos
+scratch_hot_age = timedelta(hours = 24)
+scratch_hot_patterns = ['*.ts', '*.frames.txt']
+
+# Files read together with the file of the same name, like the lists of the frames of the videos, they stay in and leave the scratch directory with it
+scratch_sidecar_suffixes = ['.frames.txt']
 
 # Parameters for images
 image_large_size = '1024x1024>'
 image_medium_size = '128x128>'
 image_small_size = '45x45>'
 
+# Image formats to make in addition to png for each kind of latest image (the button needs transparency)
+latest_image_formats = {
+	'large': ['jpg', 'webp', 'avif'],
+	'medium': ['jpg', 'webp', 'avif'],
+	'small': ['jpg', 'webp', 'avif'],
+	'button': ['webp', 'avif'],
+}
+
+# Image formats to make in addition to png for the archived images
+archive_image_formats = ['webp']
+
 # Parameters for videos
 video_frame_rate = 16
 
+# The daily and latest videos are encoded in chunks of that many input videos in parallel, then concatenated without reencoding
+video_chunk_size = 4
+
+# Max number of chunks of a video encoded in parallel
+video_chunk_workers = 4
+
+# Parameters for the sprites of the video pieces, that contain a thumbnail per cadence period of the hour, tiled row by row
+sprite_cadence = timedelta(minutes = 2)
+sprite_columns = 6
+sprite_thumbnail_size = 96
+
+# Presets of the encoder per kind of video
+video_presets = {'piece': 'slow', 'mp4': 'slow'}
+
+# When the daemon is behind, because there are more than catchup_max_backlog fits files to convert and video pieces to make, or because a loop of the daemon took more than catchup_max_lag,
+# the mp4 videos are made with the catch up presets and marked as provisional, to be made again with the normal presets once the backlog is below restore_max_backlog
+# The video pieces are always made with the normal preset, as they are kept as the source of all the other videos
+catchup_video_presets = {'mp4': 'veryfast'}
+catchup_max_backlog = 1000
+catchup_max_lag = timedelta(minutes = 30)
+restore_max_backlog = 100
+
+# Source of the frames of the video pieces
+#  png: the images made by fits2png are read back and piped to ffmpeg as png
+#  raw: the fits files are decoded and colored in python, and the frames are piped to ffmpeg as raw video while they are made
+#       the scaling and the aia_lct color tables of make_frame approximate those of fits2png, so the colors of the video pieces differ slightly from those of the images
+video_frame_source = 'png'
+
+# With the raw frame source, also make the images of the archive with fits2png, so that the archived images are the same whatever the source of the frames
+# The composite images, that fits2png cannot make, are written from the frames
+# The video pieces are still only made from the decoded frames, even the missing ones, so that their colors do not change from one hour to the next
+archive_images = True
+
+# Time to wait for frames arriving out of order before encoding them in the video pieces
+piece_reorder_delay = timedelta(minutes = 1)
+
+# The clock of the daemon, that can be replaced to run the daemon on a simulated time
+clock = Clock()
+
+# The stop_daemon will tell all threads to terminate gracefully
+stop_daemon = threading.Event()
+
 # Duration in hours of the latest videos per wavelength
-latest_video_length = dict.fromkeys(AIA_wavelengths, 24)
+latest_video_length = dict.fromkeys(products, 24)
 latest_video_length[4500] = 24 * 20
 
+# Cadences of the decimated videos per product, from the finest to the coarsest
+# For each day, a decimated video keeping one frame per cadence period is made from the video pieces for the finest cadence, and from the decimated video of the previous cadence for the others
+decimated_video_cadences = dict.fromkeys(products, [])
+decimated_video_cadences[4500] = [timedelta(minutes = 10), timedelta(hours = 1)]
+
+# Min number of frames of the latest videos, they are made from the decimated videos of the coarsest cadence giving at least that many frames
+latest_video_min_frames = 400
+
 class SharedCache(object):
 	def __init__(self):
 		self.lock = threading.Lock()
@@ -71,20 +199,167 @@ class SharedCache(object):
 	
 	def add(self, item):
 		self.lock.acquire()
-		self.cache[item] = datetime.now()
+		self.cache[item] = clock.now()
 		self.lock.release()
 	
 	def __contains__(self, item):
 		return item in self.cache
 	
 	def clean(self, age):
-		now = datetime.now()
+		now = clock.now()
 		self.lock.acquire()
-		for key, value in self.cache.iteritems():
+		for key, value in self.cache.items():
 			if value + age < now:
 				del self.cache[key]
 		self.lock.release()
 
+class LatestFrames(object):
+	'''Keep in memory the latest decoded frame of each product, to make the latest images when the frames are not archived as images'''
+	
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.frames = dict()
+	
+	def add(self, product, date, frame):
+		self.lock.acquire()
+		if product not in self.frames or date > self.frames[product][0]:
+			self.frames[product] = (date, frame)
+		self.lock.release()
+	
+	def get(self, product):
+		return self.frames[product][1]
+
+class PieceEncoders(object):
+	'''Encode decoded frames directly into the video piece of their hour, without writing images
+	Each product has its own lock, so that the frames of different products are written to their encoders in parallel'''
+	
+	def __init__(self, reorder_delay):
+		self.lock = threading.Lock()
+		self.reorder_delay = reorder_delay
+		self.products = dict()
+		self.known_frames = dict()
+		self.video_pieces = list()
+	
+	def contains(self, product, date, frame_name):
+		'''Return True if a frame is already in the video piece of its hour'''
+		video_path = video_piece_pattern.format(date=round_to_hour(date), wavelength=product)
+		self.lock.acquire()
+		known_frames = self.known_frames.get(video_path)
+		self.lock.release()
+		
+		# The list of frames is read outside of the lock, if two threads read it at the same time the first one read is kept
+		if known_frames is None:
+			known_frames = set(read_video_piece_frames(scratch.find(video_path)) or [])
+			self.lock.acquire()
+			known_frames = self.known_frames.setdefault(video_path, known_frames)
+			self.lock.release()
+		
+		return frame_name in known_frames
+	
+	def get_product(self, product):
+		'''Return the state of a product, that is its lock, its buffer of frames and its current encoder'''
+		self.lock.acquire()
+		try:
+			if product not in self.products:
+				self.products[product] = {'lock': threading.Lock(), 'buffer': FrameRingBuffer(1, self.reorder_delay), 'encoder': None}
+			return self.products[product]
+		finally:
+			self.lock.release()
+	
+	def add(self, product, date, frame, frame_name):
+		'''Add a frame to be encoded, the frames are encoded in chronological order once no earlier frame is expected anymore'''
+		state = self.get_product(product)
+		state['lock'].acquire()
+		try:
+			if state['buffer'].add(date, (frame, frame_name)):
+				self.write_released(product, state)
+			else:
+				logging.warning('Frame %s arrived too late, it will be out of order in its video piece', frame_name)
+				self.write(product, state, date, frame, frame_name)
+		finally:
+			state['lock'].release()
+	
+	def write_released(self, product, state, flush = False):
+		for date, (frame, frame_name) in state['buffer'].release(flush):
+			# The ring only needs to know the date of the last frame
+			state['buffer'].append(date, None)
+			self.write(product, state, date, frame, frame_name)
+	
+	def write(self, product, state, date, frame, frame_name):
+		video_piece_date = round_to_hour(date)
+		
+		# Frames of a new hour go to a new video piece
+		if state['encoder'] is not None and state['encoder']['date'] != video_piece_date:
+			self.close_encoder(product, state)
+		
+		if state['encoder'] is None:
+			video_path = video_piece_pattern.format(date=video_piece_date, wavelength=product)
+			make_directory(os.path.dirname(scratch.local_path(video_path)))
+			height, width = frame.shape[:2]
+			encoder = raw_to_ts_video_encoder(scratch.local_path(video_path) + '.part', width, height, pixel_format = 'rgb24' if frame.ndim == 3 else 'gray', frame_rate = video_frame_rate, video_preset = video_presets['piece'])
+			if encoder is None:
+				logging.error('Error while starting encoder for video piece %s', video_path)
+				return
+			state['encoder'] = {'date': video_piece_date, 'video_path': video_path, 'encoder': encoder, 'frames': list()}
+		
+		try:
+			state['encoder']['encoder'].write(frame.tostring())
+		except Exception, why:
+			logging.error('Error writing frame to encoder for video piece %s: %s', state['encoder']['video_path'], why)
+		else:
+			state['encoder']['frames'].append(frame_name)
+	
+	def close_encoder(self, product, state):
+		encoder = state['encoder']
+		state['encoder'] = None
+		temp_video_path = scratch.local_path(encoder['video_path']) + '.part'
+		
+		# The frames of each run are appended to the video piece of the hour, ts videos can be concatenated
+		if encoder['encoder'].close():
+			try:
+				with open(scratch.fetch(encoder['video_path']), 'ab') as video_piece, open(temp_video_path, 'rb') as video_part:
+					shutil.copyfileobj(video_part, video_piece)
+				with open(scratch.fetch(get_video_piece_frames_path(encoder['video_path'])), 'a') as frames_file:
+					for frame_name in encoder['frames']:
+						frames_file.write(frame_name + '\n')
+			except Exception, why:
+				logging.error('Error appending %s to video piece %s: %s', temp_video_path, encoder['video_path'], why)
+			else:
+				scratch.publish([encoder['video_path'], get_video_piece_frames_path(encoder['video_path'])])
+				self.lock.acquire()
+				self.video_pieces.append({'wavelength': product, 'date': encoder['date'], 'video_path': encoder['video_path']})
+				self.lock.release()
+		else:
+			logging.error('Error while making video piece %s', encoder['video_path'])
+		
+		try:
+			os.remove(temp_video_path)
+		except OSError:
+			pass
+	
+	def close(self):
+		'''Encode the frames still waiting, close all the encoders and return the video pieces that were made since the last close'''
+		self.lock.acquire()
+		products = self.products.items()
+		self.lock.release()
+		
+		for product, state in products:
+			state['lock'].acquire()
+			try:
+				self.write_released(product, state, flush = True)
+				if state['encoder'] is not None:
+					self.close_encoder(product, state)
+			finally:
+				state['lock'].release()
+		
+		self.lock.acquire()
+		video_pieces = self.video_pieces
+		self.video_pieces = list()
+		self.known_frames = dict()
+		self.lock.release()
+		
+		return video_pieces
+
 def make_directory(directory):
 	'''Create a directory and all the subdirectories'''
 	try:
@@ -112,6 +387,36 @@ def get_keywords(fitsfile, keywords):
 	
 	return result
 
+def get_frame_date(frame_name):
+	'''Return the date of a frame from its file name, or None if the file name does not contain one'''
+	match = re.search(r'(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2})', frame_name)
+	if match is None:
+		return None
+	else:
+		return datetime(*[int(value) for value in match.groups()])
+
+def get_video_piece_frames_path(video_path):
+	'''Return the path of the file listing the frames of a video piece'''
+	return os.path.splitext(video_path)[0] + '.frames.txt'
+
+def write_video_piece_frames(video_path, frames):
+	'''Write the names of the frames of a video piece, in the order of the video'''
+	with open(get_video_piece_frames_path(video_path), 'w') as frames_file:
+		for frame in frames:
+			frames_file.write(os.path.basename(frame) + '\n')
+
+def get_archive_image_paths(image_path):
+	'''Return the paths of all the formats of an archived image'''
+	return [image_path] + [os.path.splitext(image_path)[0] + '.' + image_format for image_format in archive_image_formats]
+
+def read_video_piece_frames(video_path):
+	'''Return the names of the frames of a video piece, or None if they are unknown'''
+	try:
+		with open(get_video_piece_frames_path(video_path)) as frames_file:
+			return [line.strip() for line in frames_file if line.strip()]
+	except IOError:
+		return None
+
 def get_daily_video_dates(date):
 	# There is one video starting at midnight, and one at noon
 	day = date.replace(hour=0, minute=0, second=0, microsecond=0)
@@ -121,11 +426,156 @@ def get_daily_video_dates(date):
 	else:
 		return day + timedelta(hours=12), day + timedelta(hours=24)
 
+def get_day_video_pieces(wavelength, date):
+	'''Return the paths of the existing video pieces of a day'''
+	video_pieces = list()
+	for hours in range(24):
+		video_piece = scratch.find(video_piece_pattern.format(date = date + timedelta(hours = hours), wavelength = wavelength))
+		if os.path.exists(video_piece):
+			video_pieces.append(video_piece)
+	return video_pieces
+
+def get_decimated_video_path(wavelength, date, cadence):
+	'''Return the path of the decimated video of a day for a cadence'''
+	return decimated_video_pattern.format(date = date, wavelength = wavelength, cadence = int(cadence.total_seconds()))
+
+def decimate_frames(frames, start, cadence):
+	'''Return the numbers of the frames to keep to have at most one frame per cadence period since start'''
+	frame_numbers = list()
+	periods = set()
+	for frame_number, frame in enumerate(frames):
+		date = get_frame_date(frame)
+		if date is None:
+			continue
+		period = int((date - start).total_seconds() // cadence.total_seconds())
+		if period not in periods:
+			periods.add(period)
+			frame_numbers.append(frame_number)
+	return frame_numbers
+
+def get_latest_video_cadence(wavelength):
+	'''Return the coarsest cadence of the decimated videos giving enough frames for the latest video of a wavelength, or None if it must be made from the video pieces'''
+	latest_video_cadence = None
+	for cadence in decimated_video_cadences[wavelength]:
+		if timedelta(hours = latest_video_length[wavelength]).total_seconds() / cadence.total_seconds() >= latest_video_min_frames:
+			latest_video_cadence = cadence
+	return latest_video_cadence
+
+def get_sprite_path(wavelength, date):
+	'''Return the path of the sprite of the video piece of an hour'''
+	return os.path.join(images_directory_pattern.format(date=date), sprite_pattern.format(date=date, wavelength=wavelength))
+
+def get_public_url(path):
+	'''Return the URL on the website of a file of the public directory'''
+	return public_url + os.path.relpath(path, public_directory)
+
+def format_vtt_time(seconds):
+	'''Return a time in seconds formatted like in WebVTT files'''
+	milliseconds = int(round(seconds * 1000))
+	return '%02d:%02d:%02d.%03d' % (milliseconds / 3600000, milliseconds / 60000 % 60, milliseconds / 1000 % 60, milliseconds % 1000)
+
+def write_video_thumbnails(vtt_path, wavelength, video_parts, start, end, frame_rate):
+	'''Write the WebVTT track of the thumbnails of a video made of video parts, pointing into the sprites of the hours from start to end'''
+	
+	# We make the list of frames of the video
+	video_frames = list()
+	for video_part in video_parts:
+		frames = read_video_piece_frames(video_part)
+		if frames is None:
+			logging.warning('Frames of video %s not found, cannot make thumbnails track %s', video_part, vtt_path)
+			return False
+		video_frames.extend(frames)
+	
+	frame_numbers = dict((frame, frame_number) for frame_number, frame in enumerate(video_frames))
+	frame_dates = sorted((get_frame_date(frame), frame_number) for frame_number, frame in enumerate(video_frames) if get_frame_date(frame) is not None)
+	
+	# A thumbnail is shown from its frame to the frame of the next thumbnail
+	# If its frame is not in the video, like for the decimated videos, it is shown from the next frame of the video
+	cues = list()
+	date = round_to_hour(start)
+	while date < end:
+		sprite_path = get_sprite_path(wavelength, date)
+		sprite_frames = read_video_piece_frames(scratch.find(sprite_path))
+		if sprite_frames:
+			columns = min(sprite_columns, len(sprite_frames))
+			for thumbnail_number, frame in enumerate(sprite_frames):
+				if frame in frame_numbers:
+					frame_number = frame_numbers[frame]
+				elif get_frame_date(frame) is not None:
+					index = bisect.bisect_left(frame_dates, (get_frame_date(frame), 0))
+					if index >= len(frame_dates):
+						continue
+					frame_number = frame_dates[index][1]
+				else:
+					continue
+				thumbnail = '{url}#xywh={x},{y},{size},{size}'.format(url = get_public_url(sprite_path), x = thumbnail_number % columns * sprite_thumbnail_size, y = thumbnail_number / columns * sprite_thumbnail_size, size = sprite_thumbnail_size)
+				cues.append((frame_number, thumbnail))
+		date += timedelta(hours = 1)
+	
+	if not cues:
+		logging.warning('No sprites found to make thumbnails track %s, skipping!', vtt_path)
+		return False
+	
+	cues.sort()
+	
+	with open(vtt_path, 'w') as vtt_file:
+		vtt_file.write('WEBVTT\n')
+		for cue_number, (frame_number, thumbnail) in enumerate(cues):
+			next_frame_number = cues[cue_number + 1][0] if cue_number + 1 < len(cues) else len(video_frames)
+			if next_frame_number > frame_number:
+				vtt_file.write('\n{start} --> {end}\n{thumbnail}\n'.format(start = format_vtt_time(float(frame_number) / frame_rate), end = format_vtt_time(float(next_frame_number) / frame_rate), thumbnail = thumbnail))
+	
+	return True
+
+def get_video_preset(kind):
+	'''Return the preset of the encoder for a kind of video, a fast one if the daemon is catching up'''
+	if catchup:
+		return catchup_video_presets[kind]
+	else:
+		return video_presets[kind]
+
+def is_provisional(video_path):
+	'''Return True if a video was made with the catch up presets'''
+	return os.path.exists(video_path + '.provisional')
+
+def set_provisional(video_path, provisional):
+	'''Mark a video as made with the catch up presets, or remove the mark'''
+	marker_path = video_path + '.provisional'
+	try:
+		if provisional:
+			make_directory(os.path.dirname(marker_path))
+			open(marker_path, 'w').close()
+		elif os.path.exists(marker_path):
+			os.remove(marker_path)
+	except (IOError, OSError), why:
+		logging.error('Error marking video %s as provisional: %s', video_path, why)
+
 def terminate_gracefully(signal, frame):
 	logging.info('Received signal %s: Exiting gracefully', signal)
 	stop_daemon.set()
 	sys.exit(0)
 
+def start_retention(retention_process):
+	'''Start the application of the retention policies in a low priority background process, unless it is still running'''
+	if retention_process is not None and retention_process.poll() is None:
+		logging.info('Retention process %s still running, not starting a new one', retention_process.pid)
+		return retention_process
+	
+	retention = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'apply_retention.py'), '--low_priority']
+	if scratch_directory is not None:
+		retention.extend(['--scratch_directory', scratch_directory])
+	if logging.root.isEnabledFor(logging.DEBUG):
+		retention.append('--debug')
+	elif logging.root.isEnabledFor(logging.INFO):
+		retention.append('--verbose')
+	
+	try:
+		logging.info('Starting retention process: %s', ' '.join(retention))
+		return subprocess.Popen(retention, shell=False, close_fds = True)
+	except Exception, why:
+		logging.error('Failed starting retention process: %s', why)
+		return None
+
 def run_threads(target, args=(), kwargs={}):
 	threads = list()
 	
@@ -148,18 +598,28 @@ def make_images():
 	output_queue = Queue.Queue()
 	
 	# Start date of images
-	date = round_to_hour(datetime.utcnow()) - timedelta(hours = time_span)
+	date = round_to_hour(clock.utcnow()) - timedelta(hours = time_span)
 	
-	# Add the fitsfiles to the input queue
-	for wavelength in AIA_wavelengths:
-		for hours in range(time_span + 1):
+	# Get the fitsfiles of each wavelength
+	fitsfiles = dict((wavelength, list()) for wavelength in AIA_wavelengths)
+	for hours in range(time_span + 1):
+		for wavelength in AIA_wavelengths:
 			directory_path = fitsfiles_directory.format(date=date + timedelta(hours = hours), wavelength=wavelength)
 			logging.debug('Getting fits files for directory %s', directory_path)
-			for fitsfile in glob.glob(os.path.join(directory_path, '*.fits')):
-				input_queue.put(fitsfile)
+			fitsfiles[wavelength].extend(glob.glob(os.path.join(directory_path, '*.fits')))
+	
+	# Add the fitsfiles to the input queue, in chronological order so that the images of a composite product are made at about the same time
+	for fitsfile in sorted((fitsfile for wavelength in AIA_wavelengths for fitsfile in fitsfiles[wavelength]), key = lambda fitsfile: (get_frame_date(os.path.basename(fitsfile)), fitsfile)):
+		input_queue.put(fitsfile)
+	
+	# The fitsfiles already converted to images that must be decoded again for the frames of the other products
+	backfill_fitsfiles = get_backfill_fitsfiles(fitsfiles)
+	
+	# The fitsfiles that were not yet converted when the images were started to be made
+	pending_fitsfiles = list()
 	
 	# Make the images in parralel threads
-	run_threads(target=thread_make_images, kwargs={'input_queue': input_queue, 'output_queue': output_queue})
+	run_threads(target=thread_make_images, kwargs={'input_queue': input_queue, 'output_queue': output_queue, 'backfill_fitsfiles': backfill_fitsfiles, 'pending_fitsfiles': pending_fitsfiles})
 	
 	# Extract the images from the output queue
 	images = list()
@@ -169,9 +629,78 @@ def make_images():
 		except Queue.Empty:
 			continue
 	
-	return images
+	# Publish all the images at once
+	scratch.publish([path for image in images if image['path'] for path in get_archive_image_paths(image['path'])])
+	
+	return images, len(pending_fitsfiles)
+
+def get_backfill_fitsfiles(fitsfiles):
+	'''Return the fitsfiles already converted to images that must be decoded again, because the frames of composite or difference products using them are missing, like after a restart'''
+	backfill_fitsfiles = set()
+	
+	# The fitsfiles of the wavelengths of the composite and difference products, sorted by date
+	dated_fitsfiles = dict()
+	for wavelength in set(frame_matcher.wavelengths + difference_maker.wavelengths):
+		dated_fitsfiles[wavelength] = sorted((get_frame_date(os.path.basename(fitsfile)), fitsfile) for fitsfile in fitsfiles[wavelength] if get_frame_date(os.path.basename(fitsfile)) is not None)
+	
+	# The date of a composite is the date of the frame of its first wavelength
+	for composite in composite_products:
+		for date, fitsfile in dated_fitsfiles[composite.wavelengths[0]]:
+			if fitsfile in decoded_fitsfiles or composite_exists(composite, date):
+				continue
+			
+			for wavelength in composite.wavelengths:
+				start = bisect.bisect_left(dated_fitsfiles[wavelength], (date - composite_max_time_difference, ''))
+				end = bisect.bisect_right(dated_fitsfiles[wavelength], (date + composite_max_time_difference, '~'))
+				for frame_date, frame_fitsfile in dated_fitsfiles[wavelength][start:end]:
+					if frame_fitsfile not in decoded_fitsfiles:
+						backfill_fitsfiles.add(frame_fitsfile)
+	
+	# The frames of a difference product are made from the frame of its date and a reference frame, that must go through the frame ring buffer before it
+	for difference in difference_products:
+		for index, (date, fitsfile) in enumerate(dated_fitsfiles[difference.wavelength]):
+			if fitsfile in decoded_fitsfiles or difference_exists(difference, date):
+				continue
+			
+			backfill_fitsfiles.add(fitsfile)
+			
+			# The reference of a base difference is the first frame of the hour, and the one of a running difference is the frame taken lag before
+			if difference.mode == 'base':
+				start = bisect.bisect_left(dated_fitsfiles[difference.wavelength], (round_to_hour(date), ''))
+				references = dated_fitsfiles[difference.wavelength][start:start + 1]
+			else:
+				start = bisect.bisect_left(dated_fitsfiles[difference.wavelength], (date - difference.lag - difference_max_time_difference, ''))
+				references = dated_fitsfiles[difference.wavelength][start:index]
+			
+			for reference_date, reference_fitsfile in references:
+				if reference_fitsfile not in decoded_fitsfiles:
+					backfill_fitsfiles.add(reference_fitsfile)
+	
+	logging.debug('%d fits files will be decoded for the missing frames of the composite and difference products', len(backfill_fitsfiles))
+	
+	return backfill_fitsfiles
+
+def get_composite_image_path(composite, date):
+	'''Return the path of the image of a composite product'''
+	return os.path.join(images_directory_pattern.format(date=date), composite_image_pattern.format(date=date, wavelength=composite))
 
-def thread_make_images(input_queue, output_queue):
+def composite_exists(composite, date):
+	'''Return True if the frame of a composite product was already made, as an image or with the raw frame source in its video piece'''
+	composite_image_path = get_composite_image_path(composite, date)
+	if video_frame_source == 'raw':
+		return piece_encoders.contains(composite, date, os.path.basename(composite_image_path))
+	else:
+		return os.path.isfile(scratch.find(composite_image_path))
+
+def get_difference_frame_name(difference, date):
+	'''Return the name of a frame of a difference product in its video piece'''
+	return os.path.splitext(composite_image_pattern.format(date=date, wavelength=difference))[0]
+
+def difference_exists(difference, date):
+	'''Return True if the frame of a difference product is already in its video piece'''
+	return piece_encoders.contains(difference, date, get_difference_frame_name(difference, date))
+
+def thread_make_images(input_queue, output_queue, backfill_fitsfiles = set(), pending_fitsfiles = list()):
 	
 	while not input_queue.empty() and not stop_daemon.is_set():
 		
@@ -201,7 +730,8 @@ def thread_make_images(input_queue, output_queue):
 		# We check if the file already exists
 		image_directory = images_directory_pattern.format(date=date_obs)
 		image_path = os.path.join(image_directory, os.path.splitext(os.path.basename(fitsfile))[0]+ '.png')
-		if os.path.isfile(image_path):
+		image_exists = os.path.isfile(scratch.find(image_path))
+		if image_exists and video_frame_source == 'png' and fitsfile not in backfill_fitsfiles:
 			logging.debug('Fits file %s already converted to image %s, skipping!', fitsfile, image_path)
 			continue
 		
@@ -229,16 +759,96 @@ def thread_make_images(input_queue, output_queue):
 			bad_fitsfiles.add(fitsfile)
 			continue
 		
-		# We make the image directory
-		make_directory(image_directory)
+		# The images of the archive are always made by fits2png
+		to_image = (video_frame_source == 'png' or archive_images) and not image_exists
 		
-		# We make the image
-		logging.info('Making image for file %s', fitsfile)
-		if fits_to_png(fitsfile, image_directory):
-			output_queue.put({'date': date_obs, 'wavelength': wavelength, 'path': image_path})
+		# With the raw frame source, the frames missing from the video pieces are made from the fits files, whether or not they were archived as images
+		to_video_piece = video_frame_source == 'raw' and not piece_encoders.contains(wavelength, date_obs, os.path.basename(image_path))
+		if not to_image and not to_video_piece and fitsfile not in backfill_fitsfiles:
+			logging.debug('Fits file %s already converted to image and in video piece, skipping!', fitsfile)
+			continue
 		
-		else:
-			logging.error('Error while making image from file %s', fitsfile)
+		# The fits files to backfill are only decoded for the frames of the other products
+		image_made = False
+		
+		if to_image or to_video_piece:
+			pending_fitsfiles.append(fitsfile)
+		
+		if to_image:
+			
+			# We make the image directory
+			make_directory(scratch.local_path(image_directory))
+			
+			# We make the image
+			logging.info('Making image for file %s', fitsfile)
+			if fits_to_png(fitsfile, os.path.dirname(scratch.output_path(image_path))):
+				image_made = True
+				output_queue.put({'date': date_obs, 'wavelength': wavelength, 'path': image_path})
+				
+				# We make the other formats of the image from the png
+				if archive_image_formats and not image_to_formats(scratch.local_path(image_path), [scratch.output_path(path) for path in get_archive_image_paths(image_path)[1:]]):
+					logging.error('Error while making other formats of image %s', image_path)
+			
+			else:
+				logging.error('Error while making image from file %s', fitsfile)
+		
+		# We decode the fits file once in python for the video pieces and all the composite and difference products using its wavelength
+		# The fits files that get an image are also decoded by fits2png, as the colors of the frames only approximate those of fits2png
+		if to_video_piece or wavelength in frame_matcher.wavelengths or wavelength in difference_maker.wavelengths:
+			try:
+				data, header = read_frame(fitsfile)
+				frame = scale_frame(data, header, wavelength)
+			except Exception, why:
+				logging.error('Error decoding image from file %s: %s', fitsfile, why)
+				continue
+			
+			decoded_fitsfiles.add(fitsfile)
+			
+			if to_video_piece:
+				logging.info('Making frame for file %s', fitsfile)
+				colorized_frame = colorize_frame(frame, wavelength)
+				piece_encoders.add(wavelength, date_obs, colorized_frame, os.path.basename(image_path))
+				latest_frames.add(wavelength, date_obs, colorized_frame)
+				
+				# Without an image, the latest images are made from the frame
+				if not image_made:
+					output_queue.put({'date': date_obs, 'wavelength': wavelength, 'path': None})
+			
+			if wavelength in frame_matcher.wavelengths:
+				for composite, composite_date, frames in frame_matcher.add(wavelength, date_obs, frame):
+					composite_image_path = get_composite_image_path(composite, composite_date)
+					if composite_exists(composite, composite_date):
+						logging.debug('Composite image %s already made, skipping!', composite_image_path)
+					else:
+						logging.info('Making composite image %s', composite_image_path)
+						output_frame(composite, composite_date, composite.blend(frames), composite_image_path, output_queue)
+			
+			if wavelength in difference_maker.wavelengths:
+				for difference, difference_date, difference_frame in difference_maker.add(wavelength, date_obs, frame):
+					if difference_exists(difference, difference_date):
+						logging.debug('Frame of %s at %s already in video piece, skipping!', difference, difference_date)
+					else:
+						piece_encoders.add(difference, difference_date, difference_frame, get_difference_frame_name(difference, difference_date))
+
+def output_frame(product, date, frame, image_path, output_queue):
+	'''Send a decoded frame of a composite product to the encoder of its video piece and/or write it as an image, depending on the source of the frames of the video pieces'''
+	if video_frame_source == 'raw':
+		piece_encoders.add(product, date, frame, os.path.basename(image_path))
+		latest_frames.add(product, date, frame)
+	
+	if video_frame_source == 'png' or archive_images:
+		make_directory(os.path.dirname(scratch.local_path(image_path)))
+		
+		# The png and the other formats of the image are made from the same frame
+		height, width = frame.shape[:2]
+		if not raw_to_formats(frame.tostring(), width, height, [scratch.output_path(path) for path in get_archive_image_paths(image_path)], pixel_format = 'rgb' if frame.ndim == 3 else 'gray'):
+			logging.error('Error while making image %s', image_path)
+			return
+		
+		output_queue.put({'date': date, 'wavelength': product, 'path': image_path})
+	
+	else:
+		output_queue.put({'date': date, 'wavelength': product, 'path': None})
 
 
 def make_latest_images(latest_images_to_make):
@@ -268,26 +878,50 @@ def thread_make_latest_images(input_queue):
 		
 		latest_image_path = latest_image_pattern.format(wavelength=image['wavelength'], suffix='large.png')
 		
-		logging.debug('Copying %s to %s', image['path'], latest_image_path)
-		try:
+		# Without archived image, the latest image is made from the latest decoded frame
+		if image['path'] is None:
+			frame = latest_frames.get(image['wavelength'])
+			height, width = frame.shape[:2]
 			make_directory(os.path.dirname(latest_image_path))
-			shutil.copy(image['path'], latest_image_path)
-		except Exception, why:
-			logging.error('Error copying %s to %s: %s', image['path'], latest_image_path, why)
+			success = raw_to_png(frame.tostring(), width, height, latest_image_path, pixel_format = 'rgb' if frame.ndim == 3 else 'gray')
+		
 		else:
-			# We use the large image to create the corresponding thumbnails
-			image_to_thumbnail(latest_image_path, latest_image_pattern.format(wavelength=image['wavelength'], suffix='small.png'), image_small_size)
-			image_to_thumbnail(latest_image_path, latest_image_pattern.format(wavelength=image['wavelength'], suffix='medium.png'), image_medium_size)
-			image_to_button(latest_image_path, latest_image_pattern.format(wavelength=image['wavelength'], suffix='button.png'), image_medium_size)
+			logging.debug('Copying %s to %s', image['path'], latest_image_path)
+			try:
+				make_directory(os.path.dirname(latest_image_path))
+				shutil.copy(scratch.find(image['path']), latest_image_path)
+			except Exception, why:
+				logging.error('Error copying %s to %s: %s', image['path'], latest_image_path, why)
+				success = False
+			else:
+				success = True
+		
+		if success:
+			# We use the large image to create the other formats and the corresponding thumbnails
+			# If a format could not be made, like avif without its delegate, the previous one is older than the png and is not served anymore
+			if latest_image_formats['large'] and not image_to_formats(latest_image_path, get_latest_image_paths(image['wavelength'], 'large', with_png = False)):
+				logging.error('Error while making other formats of latest image %s', latest_image_path)
+			for kind, size, transparent in [('small', image_small_size, False), ('medium', image_medium_size, False), ('button', image_medium_size, True)]:
+				if not image_to_formats(latest_image_path, get_latest_image_paths(image['wavelength'], kind), size, transparent = transparent):
+					logging.error('Error while making %s latest image for wavelength %s', kind, image['wavelength'])
+
+def get_latest_image_paths(wavelength, kind, with_png = True):
+	'''Return the paths of all the formats of a kind of latest image'''
+	image_formats = latest_image_formats[kind]
+	if with_png:
+		image_formats = ['png'] + image_formats
+	
+	return [latest_image_pattern.format(wavelength=wavelength, suffix=kind + '.' + image_format) for image_format in image_formats]
 
 
 def make_video_pieces(video_pieces_to_make):
 	
 	# Start date of video pieces
-	date = round_to_hour(datetime.utcnow()) - timedelta(hours = time_span)
+	date = round_to_hour(clock.utcnow()) - timedelta(hours = time_span)
 	
-	# Add the missing videos pieces
-	for wavelength in AIA_wavelengths:
+	# Add the missing videos pieces, with the raw frame source their missing frames are made again from the fits files by make_images
+	# The video pieces of the difference products are only made from the decoded frames, their missing frames are backfilled by make_images
+	for wavelength in image_products if video_frame_source == 'png' else []:
 		for hours in range(time_span + 1):
 			video_path = video_piece_pattern.format(date = date + timedelta(hours = hours), wavelength = wavelength)
 			if not os.path.exists(video_path):
@@ -314,6 +948,9 @@ def make_video_pieces(video_pieces_to_make):
 			except Queue.Empty:
 				continue
 		
+		# Publish all the videos pieces at once
+		scratch.publish([path for video_piece in video_pieces for path in (video_piece['video_path'], get_video_piece_frames_path(video_piece['video_path']))])
+		
 		return video_pieces
 	
 	else:
@@ -332,25 +969,85 @@ def thread_make_video_pieces(input_queue, output_queue, video_frame_rate = 24, v
 		
 		# We make the list of frames
 		images_directory = images_directory_pattern.format(date=date)
-		images = sorted(glob.glob(os.path.join(images_directory, '*%04d.quicklook.png' % wavelength)))
+		images = sorted(scratch.glob(os.path.join(images_directory, '*{wavelength:04d}.quicklook.png'.format(wavelength=wavelength))), key = os.path.basename)
 		
 		if not images:
-			logging.warning('No images found to make video piece for date %s and wavelength %d, skipping!', date, wavelength)
+			logging.warning('No images found to make video piece for date %s and wavelength %s, skipping!', date, wavelength)
 			continue
 		
 		video_path = video_piece_pattern.format(date=date, wavelength=wavelength)
-		make_directory(os.path.dirname(video_path))
+		make_directory(os.path.dirname(scratch.local_path(video_path)))
 		
 		# We make the video piece
-		if png_to_ts_video(images, video_path, frame_rate = video_frame_rate, video_title = video_title, video_size = video_size, video_bitrate = video_bitrate, video_preset='slow'):
+		if png_to_ts_video(images, scratch.output_path(video_path), frame_rate = video_frame_rate, video_title = video_title, video_size = video_size, video_bitrate = video_bitrate, video_preset = video_presets['piece']):
+			# We keep the list of frames, so that the video piece can be cut at a precise time
+			try:
+				write_video_piece_frames(scratch.local_path(video_path), images)
+			except Exception, why:
+				logging.error('Error writing the list of frames of video piece %s: %s', video_path, why)
 			output_queue.put({'wavelength': wavelength, 'date': date, 'video_path': video_path})
 		else:
-			logging.error('Error while making video piece for date %s and wavelength %d', date, wavelength)
+			logging.error('Error while making video piece for date %s and wavelength %s', date, wavelength)
+
+def make_sprites(sprites_to_make):
+	
+	# The sprites that are already more recent than their video piece do not need to be made again
+	for wavelength, date in list(sprites_to_make):
+		video_piece = scratch.find(video_piece_pattern.format(date = date, wavelength = wavelength))
+		sprite_path = scratch.find(get_sprite_path(wavelength, date))
+		if os.path.exists(sprite_path) and os.path.exists(video_piece) and os.path.getmtime(sprite_path) >= os.path.getmtime(video_piece):
+			sprites_to_make.discard((wavelength, date))
+	
+	if sprites_to_make:
+		
+		input_queue = Queue.Queue()
+		
+		# Add the sprites to the input queue
+		for sprite in sprites_to_make:
+			input_queue.put(sprite)
+		
+		# Make the sprites in parralel threads
+		run_threads(target=thread_make_sprites, kwargs={'input_queue': input_queue})
+	else:
+		logging.debug('No sprite to make')
+
+def thread_make_sprites(input_queue):
+	
+	while not input_queue.empty() and not stop_daemon.is_set():
+		
+		try:
+			wavelength, date = input_queue.get_nowait()
+		except Queue.Empty:
+			continue
+		
+		# We choose a frame of the video piece per cadence period
+		video_piece = scratch.find(video_piece_pattern.format(date = date, wavelength = wavelength))
+		frames = read_video_piece_frames(video_piece)
+		
+		if not frames:
+			logging.warning('Frames of video piece %s not found, cannot make sprite, skipping!', video_piece)
+			continue
+		
+		frame_numbers = decimate_frames(frames, date, sprite_cadence)
+		
+		sprite_path = get_sprite_path(wavelength, date)
+		make_directory(os.path.dirname(scratch.local_path(sprite_path)))
+		
+		# We make the sprite, and keep the list of its frames to make the thumbnails tracks of the videos
+		if video_frames_to_sprite(video_piece, scratch.output_path(sprite_path), frame_numbers, columns = sprite_columns, thumbnail_size = sprite_thumbnail_size):
+			try:
+				write_video_piece_frames(scratch.local_path(sprite_path), [frames[frame_number] for frame_number in frame_numbers])
+			except Exception, why:
+				logging.error('Error writing the list of frames of sprite %s: %s', sprite_path, why)
+			else:
+				scratch.publish([sprite_path, get_video_piece_frames_path(sprite_path)])
+		else:
+			logging.error('Error while making sprite for date %s and wavelength %s', date, wavelength)
 
 def make_latest_videos(latest_videos_to_make):
 	
 	# Add the missing latest videos
-	for wavelength in AIA_wavelengths:
+	for wavelength in products:
 		latest_video_path = latest_video_pattern.format(wavelength=wavelength, suffix='mp4')
 		if not os.path.exists(latest_video_path):
 			logging.info('Latest video %s is missing, will be made', latest_video_path)
@@ -381,46 +1078,169 @@ def thread_make_latest_videos(input_queue, video_frame_rate = 24, video_size = N
 			continue
 		
 		# Start date of the latest video (depends on wavelength)
-		date = round_to_hour(datetime.utcnow()) - timedelta(hours = latest_video_length[wavelength])
+		date = round_to_hour(clock.utcnow()) - timedelta(hours = latest_video_length[wavelength])
 		
-		# We make the list of video pieces
-		video_pieces = list()
-		for hours in range(latest_video_length[wavelength] + 1):
-			video_piece = video_piece_pattern.format(date = date + timedelta(hours = hours), wavelength = wavelength)
-			if os.path.exists(video_piece):
-				video_pieces.append(video_piece)
-			else:
-				logging.warning('Video piece %s not found, skipping!', video_piece)
+		# Make the video to a temp path as not to overwritte the latest video
+		video_path = latest_video_pattern.format(wavelength=wavelength, suffix='mp4')
+		temp_video_path = scratch.local_path(latest_video_pattern.format(wavelength=wavelength, suffix='tmp.mp4'))
+		temp_video_part_path = scratch.local_path(latest_video_pattern.format(wavelength=wavelength, suffix='tmp.ts'))
+		make_directory(os.path.dirname(temp_video_path))
+		make_directory(os.path.dirname(video_path))
+		
+		# Long videos are made from the decimated videos, so that their cost does not grow with their length
+		cadence = get_latest_video_cadence(wavelength)
+		
+		if cadence is not None:
+			video_pieces = get_decimated_video_parts(wavelength, date, cadence, temp_video_part_path)
+		else:
+			# We make the list of video pieces
+			video_pieces = list()
+			for hours in range(latest_video_length[wavelength] + 1):
+				video_piece = scratch.find(video_piece_pattern.format(date = date + timedelta(hours = hours), wavelength = wavelength))
+				if os.path.exists(video_piece):
+					video_pieces.append(video_piece)
+				else:
+					logging.warning('Video piece %s not found, skipping!', video_piece)
 		
 		if not video_pieces:
-			logging.warning('No video pieces found to make latest video for wavelength %d, skipping!', wavelength)
+			logging.warning('No video pieces found to make latest video for wavelength %s, skipping!', wavelength)
 			continue
 		
 		if video_title is None:
 			video_title = 'Video of the last {hours} hours of AIA {wavelength}Å'.format(wavelength = wavelength, hours=latest_video_length[wavelength])
 		
-		# Make the video to a temp path as not to overwritte the latest video
-		video_path = latest_video_pattern.format(wavelength=wavelength, suffix='mp4')
-		temp_video_path = latest_video_pattern.format(wavelength=wavelength, suffix='tmp.mp4')
-		make_directory(os.path.dirname(temp_video_path))
-		make_directory(os.path.dirname(video_path))
-		
 		# We make the video
-		if video_to_mp4_video(video_pieces, temp_video_path, video_frame_rate, video_title, video_size, video_bitrate):
-			# Move the temp file to it's latest path
-			logging.debug('Moving file %s to %s', temp_video_path, video_path)
-			shutil.move(temp_video_path, video_path)
+		video_preset = get_video_preset('mp4')
+		if video_to_mp4_video_chunked(video_pieces, temp_video_path, video_frame_rate, video_title, video_size, video_bitrate, video_preset, chunk_size = video_chunk_size, max_workers = video_chunk_workers):
+			# Move the temp file to it's latest path, and publish it
+			logging.debug('Moving file %s to %s', temp_video_path, scratch.local_path(video_path))
+			shutil.move(temp_video_path, scratch.output_path(video_path))
+			vtt_path = latest_video_pattern.format(wavelength=wavelength, suffix='vtt')
+			if write_video_thumbnails(scratch.local_path(vtt_path), wavelength, video_pieces, date, clock.utcnow(), video_frame_rate):
+				scratch.publish([video_path, vtt_path])
+			else:
+				scratch.publish([video_path])
+			set_provisional(video_path, video_preset != video_presets['mp4'])
+		else:
+			logging.error('Error while making latest video for wavelength %s', wavelength)
+		
+		for path in (temp_video_part_path, get_video_piece_frames_path(temp_video_part_path)):
+			if os.path.exists(path):
+				os.remove(path)
+
+
+def get_decimated_video_parts(wavelength, start, cadence, temp_video_part_path):
+	'''Return the list of the decimated videos from start to now, the first one being cut at start into the temp video part'''
+	video_parts = list()
+	
+	day = start.replace(hour=0, minute=0, second=0, microsecond=0)
+	while day <= clock.utcnow():
+		video_part = scratch.find(get_decimated_video_path(wavelength, day, cadence))
+		if not os.path.exists(video_part):
+			logging.warning('Decimated video %s not found, skipping!', video_part)
+		elif day < start:
+			# We search the frames after the start of the latest video
+			frames = read_video_piece_frames(video_part) or []
+			frame_numbers = [frame_number for frame_number, frame in enumerate(frames) if get_frame_date(frame) is not None and get_frame_date(frame) >= start]
+			if not frame_numbers:
+				logging.debug('No frame of decimated video %s after %s, skipping!', video_part, start)
+			elif frame_numbers[0] == 0:
+				video_parts.append(video_part)
+			elif video_frames_to_ts_video(video_part, temp_video_part_path, frame_numbers[0], frame_numbers[-1], frame_rate = video_frame_rate):
+				write_video_piece_frames(temp_video_part_path, frames[frame_numbers[0]:frame_numbers[-1] + 1])
+				video_parts.append(temp_video_part_path)
+			else:
+				logging.error('Error while cutting decimated video %s at %s', video_part, start)
 		else:
-			logging.error('Error while making latest video for wavelength %d', wavelength)
+			video_parts.append(video_part)
+		day += timedelta(days = 1)
+	
+	return video_parts
+
+
+def make_decimated_videos(decimated_videos_to_make):
+	
+	# Start date of the day
+	date = clock.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+	
+	# Add the missing decimated videos of the days of the latest videos, for which there are video pieces
+	for wavelength in products:
+		if not decimated_video_cadences[wavelength]:
+			continue
+		for days in range(latest_video_length[wavelength] / 24 + 2):
+			video_date = date - timedelta(days = days)
+			video_path = get_decimated_video_path(wavelength, video_date, decimated_video_cadences[wavelength][-1])
+			if not os.path.exists(video_path) and get_day_video_pieces(wavelength, video_date):
+				logging.info('Decimated video %s is missing, will be made', video_path)
+				decimated_videos_to_make.add((wavelength, video_date))
+	
+	if decimated_videos_to_make:
+		
+		input_queue = Queue.Queue()
+		
+		# Add the decimated videos to the input queue
+		for decimated_video in decimated_videos_to_make:
+			input_queue.put(decimated_video)
+		
+		# Make the decimated videos in parralel threads
+		run_threads(target=thread_make_decimated_videos, kwargs={'input_queue': input_queue, 'video_frame_rate': video_frame_rate})
+	else:
+		logging.debug('No decimated video to make')
+
+def thread_make_decimated_videos(input_queue, video_frame_rate = 24):
+	
+	while not input_queue.empty() and not stop_daemon.is_set():
+		
+		try:
+			wavelength, date = input_queue.get_nowait()
+		except Queue.Empty:
+			continue
+		
+		# The decimated video of the finest cadence is made from the video pieces, that must have their list of frames
+		input_videos = list()
+		for video_piece in get_day_video_pieces(wavelength, date):
+			if read_video_piece_frames(video_piece) is None:
+				logging.warning('Frames of video piece %s not found, skipping!', video_piece)
+			else:
+				input_videos.append(video_piece)
+		
+		# Each decimated video is made from the one of the previous cadence, so its cost does not depend on the original cadence
+		for cadence in decimated_video_cadences[wavelength]:
+			
+			frames = list()
+			for input_video in input_videos:
+				frames.extend(read_video_piece_frames(input_video))
+			
+			frame_numbers = decimate_frames(frames, date, cadence)
+			
+			if not frame_numbers:
+				logging.warning('No frames found to make decimated video for date %s, wavelength %s and cadence %s, skipping!', date, wavelength, cadence)
+				break
+			
+			video_path = get_decimated_video_path(wavelength, date, cadence)
+			make_directory(os.path.dirname(scratch.local_path(video_path)))
+			
+			# We make the decimated video
+			if video_select_frames_to_ts_video(input_videos, scratch.output_path(video_path), frame_numbers, frame_rate = video_frame_rate):
+				try:
+					write_video_piece_frames(scratch.local_path(video_path), [frames[frame_number] for frame_number in frame_numbers])
+				except Exception, why:
+					logging.error('Error writing the list of frames of decimated video %s: %s', video_path, why)
+					break
+				scratch.publish([video_path, get_video_piece_frames_path(video_path)])
+				input_videos = [scratch.local_path(video_path)]
+			else:
+				logging.error('Error while making decimated video for date %s, wavelength %s and cadence %s', date, wavelength, cadence)
+				break
 
 
 def make_daily_videos(daily_videos_to_make):
 	
 	# Start date of daily videos
-	date = round_to_hour(datetime.utcnow()) - timedelta(hours = time_span)
+	date = round_to_hour(clock.utcnow()) - timedelta(hours = time_span)
 	
 	# Add the missing daily videos
-	for wavelength in AIA_wavelengths:
+	for wavelength in products:
 		for hours in range(time_span / 12):
 			for video_date in get_daily_video_dates(date + timedelta(hours = 12 * hours)):
 				video_path = daily_video_pattern.format(date = video_date, wavelength = wavelength, suffix='mp4')
@@ -453,153 +1273,287 @@ def thread_make_daily_videos(input_queue, video_frame_rate = 24, video_size = No
 		# We make the list of video pieces
 		video_pieces = list()
 		for hours in range(24):
-			video_piece = video_piece_pattern.format(date = date + timedelta(hours = hours), wavelength = wavelength)
+			video_piece = scratch.find(video_piece_pattern.format(date = date + timedelta(hours = hours), wavelength = wavelength))
 			if os.path.exists(video_piece):
 				video_pieces.append(video_piece)
 			else:
 				logging.warning('Video piece %s not found, skipping!', video_piece)
 		
 		if not video_pieces:
-			logging.warning('No video pieces found to make daily video for date %s and wavelength %d, skipping!', date, wavelength)
+			logging.warning('No video pieces found to make daily video for date %s and wavelength %s, skipping!', date, wavelength)
 			continue
 		
 		if video_title is None:
 			video_title = 'Video of AIA {wavelength}Å from {start} to {end}'.format(wavelength = wavelength, start=date.isoformat(), end=(date+timedelta(hours=24)).isoformat())
 		
 		video_path = daily_video_pattern.format(date=date, wavelength=wavelength, suffix='mp4')
-		make_directory(os.path.dirname(video_path))
+		make_directory(os.path.dirname(scratch.local_path(video_path)))
 		
 		# We make the video
-		if video_to_mp4_video(video_pieces, video_path, video_frame_rate, video_title, video_size, video_bitrate):
-			# TODO should we make a temp video
-			pass
+		video_preset = get_video_preset('mp4')
+		if video_to_mp4_video_chunked(video_pieces, scratch.output_path(video_path), video_frame_rate, video_title, video_size, video_bitrate, video_preset, chunk_size = video_chunk_size, max_workers = video_chunk_workers):
+			vtt_path = daily_video_pattern.format(date=date, wavelength=wavelength, suffix='vtt')
+			if write_video_thumbnails(scratch.local_path(vtt_path), wavelength, video_pieces, date, date + timedelta(hours = 24), video_frame_rate):
+				scratch.publish([video_path, vtt_path])
+			else:
+				scratch.publish([video_path])
+			set_provisional(video_path, video_preset != video_presets['mp4'])
 		else:
-			logging.error('Error while making daily video for date %s and wavelength %d', date, wavelength)
-
+			logging.error('Error while making daily video for date %s and wavelength %s', date, wavelength)
 
-if __name__ == '__main__':
-	
-	# You need to force this environment variable, otherwise all child process will be forced to the same CPU
-	os.environ['OPENBLAS_MAIN_FREE'] = '1'
+def add_provisional_videos(latest_videos_to_make, daily_videos_to_make):
 	
-	# Default name for the log file
-	log_filename = os.path.splitext(sys.argv[0])[0] + '.log'
+	# The provisional daily videos are found by their marks, whatever their age, as the daemon may have been behind for longer than the time span
+	daily_videos_directory = daily_video_pattern.split('{')[0]
+	for marker_path in glob.glob(os.path.join(daily_videos_directory, '[0-9]' * 4, '[0-9]' * 2, '[0-9]' * 2, '*.mp4.provisional')):
+		video_path = marker_path[:-len('.provisional')]
+		video_name = os.path.basename(video_path)
+		video_date = get_frame_date(video_name)
+		product_name = video_name.split('.')[2]
+		if video_date is None or product_name not in products_by_name:
+			logging.warning('Unknown provisional video %s, skipping!', video_path)
+			continue
+		
+		wavelength = products_by_name[product_name]
+		if not any(os.path.exists(scratch.find(video_piece_pattern.format(date = video_date + timedelta(hours = hours), wavelength = wavelength))) for hours in range(24)):
+			logging.warning('Provisional daily video %s cannot be made again, its video pieces were deleted', video_path)
+			set_provisional(video_path, False)
+			continue
+		
+		logging.info('Daily video %s is provisional, will be made again', video_path)
+		daily_videos_to_make.add((wavelength, video_date))
 	
-	# Get the arguments
-	parser = argparse.ArgumentParser(description='Make AIA latest images and videos')
-	parser.add_argument('--debug', '-d', default=False, action='store_true', help='Set the logging level to debug')
-	parser.add_argument('--verbose', '-v', default=False, action='store_true', help='Set the logging level to info')
-	parser.add_argument('--log_filename', '-l', default=log_filename, help='Overwrite the image if it already exists')
-	parser.add_argument('--time_span', '-t', default=time_span, type=int, help='Duration in hours to go back in time for the creation of images and videos')
-	parser.add_argument('--max_threads', '-m', default=max_threads, type=int, help='Max number of concurrent threads')
+	# Add the provisional latest videos to be made again with the normal presets
+	for wavelength in products:
+		video_path = latest_video_pattern.format(wavelength=wavelength, suffix='mp4')
+		if is_provisional(video_path):
+			logging.info('Latest video %s is provisional, will be made again', video_path)
+			latest_videos_to_make.add(wavelength)
 
-	# Parse the arguments
-	args = parser.parse_args()
-	
-	if args.debug:
-		log_level = logging.DEBUG
-	elif args.verbose:
-		log_level = logging.INFO
-	else:
-		log_level = logging.ERROR
-	
-	time_span = args.time_span
-	
-	max_threads = args.max_threads
-	
-	# Setup the logging
-	logging.basicConfig(level = log_level, filename = args.log_filename, format='%(asctime)s %(levelname)-8s %(funcName)-12s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-	
-	logging.info('Starting deamon')
+
+def run_daemon():
+	'''Run the loop of the daemon until stop_daemon is set'''
 	
-	# The stop_daemon will tell all threads to terminate gracefully
-	stop_daemon = threading.Event()
-	
-	# We setup the termination signal
-	signal.signal(signal.SIGINT, terminate_gracefully)
-	signal.signal(signal.SIGHUP, signal.SIG_IGN)
-	signal.signal(signal.SIGQUIT, terminate_gracefully)
-	signal.signal(signal.SIGTERM, terminate_gracefully)
+	# The objects shared with the threads
+	global bad_fitsfiles, decoded_fitsfiles, scratch, frame_matcher, difference_maker, piece_encoders, latest_frames, catchup
 	
 	# All the media to make
 	latest_images_to_make = dict()
 	video_pieces_to_make = set()
+	sprites_to_make = set()
+	decimated_videos_to_make = set()
 	latest_videos_to_make = set()
 	daily_videos_to_make = set()
 	
 	# Last run times of functions
 	last_run_times = dict.fromkeys(max_run_frequency.keys(), datetime.min)
 	
+	# Background process applying the retention policies
+	retention_process = None
+	
+	# If the daemon is behind, the videos are made with the catch up presets
+	catchup = False
+	loop_duration = timedelta(0)
+	
 	# List of bad fitsfiles not to process
 	bad_fitsfiles = SharedCache()
 	
+	# List of fitsfiles decoded in python, not to decode again to backfill the frames of the other products
+	decoded_fitsfiles = SharedCache()
+	
+	# Local storage of the intermediate files
+	scratch = ScratchStore(scratch_directory, public_directory, scratch_size, scratch_hot_age, scratch_hot_patterns, scratch_sidecar_suffixes)
+	
+	# Images of the wavelengths of the composite products waiting to be blended
+	frame_matcher = FrameMatcher(composite_products, composite_max_time_difference, composite_max_age)
+	
+	# Last images of the wavelengths of the difference products
+	difference_maker = DifferenceMaker(difference_products, difference_buffer_size, difference_reorder_delay, difference_max_time_difference)
+	
+	# Encoders of the video pieces made directly from the decoded frames, and the latest decoded frames
+	piece_encoders = PieceEncoders(piece_reorder_delay)
+	latest_frames = LatestFrames()
+	
 	while not stop_daemon.is_set():
 		
+		loop_start = clock.now()
+		
 		# Make the images from fits files
-		if last_run_times['make_images'] + max_run_frequency['make_images'] <= datetime.now():
-			last_run_times['make_images'] = datetime.now()
-			images = make_images()
+		if last_run_times['make_images'] + max_run_frequency['make_images'] <= clock.now():
+			last_run_times['make_images'] = clock.now()
+			images, fitsfiles_backlog = make_images()
+			encoded_video_pieces = piece_encoders.close()
 		else:
 			logging.debug('Not yet time to run make_images: waiting until %s', last_run_times['make_images'] + max_run_frequency['make_images'])
 		
 		# Process the images
 		for image in images:
-			# Add the corresponding video piece to be made
-			video_pieces_to_make.add((image['wavelength'], round_to_hour(image['date'])))
+			# Add the corresponding video piece to be made, with the raw frame source it is already made
+			if video_frame_source == 'png':
+				video_pieces_to_make.add((image['wavelength'], round_to_hour(image['date'])))
 			
 			# If the image is older than the latest, add the latest image to be made
 			if image['wavelength'] not in latest_images_to_make or image['date'] > latest_images_to_make[image['wavelength']]['date']:
 				latest_images_to_make[image['wavelength']] = image
 		
+		# Decide if the daemon is behind, and must favor the latency over the quality of the videos
+		backlog = fitsfiles_backlog + len(video_pieces_to_make)
+		if backlog > catchup_max_backlog or loop_duration > catchup_max_lag:
+			if not catchup:
+				logging.warning('Daemon is behind with a backlog of %d and a loop duration of %s, making videos with the catch up presets', backlog, loop_duration)
+			catchup = True
+		elif catchup:
+			logging.warning('Daemon caught up with a backlog of %d and a loop duration of %s, making videos with the normal presets', backlog, loop_duration)
+			catchup = False
+		
 		# Make the latest images
-		if last_run_times['make_latest_images'] + max_run_frequency['make_latest_images'] <= datetime.now():
-			last_run_times['make_latest_images'] = datetime.now()
+		if last_run_times['make_latest_images'] + max_run_frequency['make_latest_images'] <= clock.now():
+			last_run_times['make_latest_images'] = clock.now()
 			make_latest_images(latest_images_to_make.values())
 		else:
 			logging.debug('Not yet time to run make_latest_images: waiting until %s', last_run_times['make_latest_images'] + max_run_frequency['make_latest_images'])
 		
 		# Make the video pieces
-		if last_run_times['make_video_pieces'] + max_run_frequency['make_video_pieces'] <= datetime.now():
-			last_run_times['make_video_pieces'] = datetime.now()
+		if last_run_times['make_video_pieces'] + max_run_frequency['make_video_pieces'] <= clock.now():
+			last_run_times['make_video_pieces'] = clock.now()
 			video_pieces = make_video_pieces(video_pieces_to_make)
 			video_pieces_to_make = set()
 		else:
 			logging.debug('Not yet time to run make_video_pieces: waiting until %s', last_run_times['make_video_pieces'] + max_run_frequency['make_video_pieces'])
 		
 		# Process the video pieces
-		for video_piece in video_pieces:
+		for video_piece in video_pieces + encoded_video_pieces:
 			# Add the corresponding daily videos to be made
 			for video_date in get_daily_video_dates(video_piece['date']):
 				daily_videos_to_make.add((video_piece['wavelength'], video_date))
 			
+			# Add the corresponding sprite to be made
+			sprites_to_make.add((video_piece['wavelength'], video_piece['date']))
+			
+			# Add the corresponding decimated videos to be made
+			if decimated_video_cadences[video_piece['wavelength']]:
+				decimated_videos_to_make.add((video_piece['wavelength'], video_piece['date'].replace(hour=0, minute=0, second=0, microsecond=0)))
+			
 			# Add the corresponding latest video to be made
-			if video_piece['date'] >= datetime.utcnow() - timedelta(hours = latest_video_length[video_piece['wavelength']]):
+			if video_piece['date'] >= clock.utcnow() - timedelta(hours = latest_video_length[video_piece['wavelength']]):
 				latest_videos_to_make.add(video_piece['wavelength'])
 		
+		# Make the sprites, before the videos that point into them
+		if last_run_times['make_sprites'] + max_run_frequency['make_sprites'] <= clock.now():
+			last_run_times['make_sprites'] = clock.now()
+			make_sprites(sprites_to_make)
+			sprites_to_make = set()
+		else:
+			logging.debug('Not yet time to run make_sprites: waiting until %s', last_run_times['make_sprites'] + max_run_frequency['make_sprites'])
+		
+		# Make the decimated videos, before the latest videos that are made from them
+		if last_run_times['make_decimated_videos'] + max_run_frequency['make_decimated_videos'] <= clock.now():
+			last_run_times['make_decimated_videos'] = clock.now()
+			make_decimated_videos(decimated_videos_to_make)
+			decimated_videos_to_make = set()
+		else:
+			logging.debug('Not yet time to run make_decimated_videos: waiting until %s', last_run_times['make_decimated_videos'] + max_run_frequency['make_decimated_videos'])
+		
 		# Make the latest videos
-		if last_run_times['make_latest_videos'] + max_run_frequency['make_latest_videos'] <= datetime.now():
-			last_run_times['make_latest_videos'] = datetime.now()
+		if last_run_times['make_latest_videos'] + max_run_frequency['make_latest_videos'] <= clock.now():
+			last_run_times['make_latest_videos'] = clock.now()
 			make_latest_videos(latest_videos_to_make)
 			latest_videos_to_make = set()
 		else:
 			logging.debug('Not yet time to run make_latest_videos: waiting until %s', last_run_times['make_latest_videos'] + max_run_frequency['make_latest_videos'])
 		
 		# Make the daily videos
-		if last_run_times['make_daily_videos'] + max_run_frequency['make_daily_videos'] <= datetime.now():
-			last_run_times['make_daily_videos'] = datetime.now()
+		if last_run_times['make_daily_videos'] + max_run_frequency['make_daily_videos'] <= clock.now():
+			last_run_times['make_daily_videos'] = clock.now()
 			make_daily_videos(daily_videos_to_make)
 			daily_videos_to_make = set()
 		else:
 			logging.debug('Not yet time to run make_daily_videos: waiting until %s', last_run_times['make_daily_videos'] + max_run_frequency['make_daily_videos'])
 		
-		# Clean the bad_fitsfiles cache
+		# Add the provisional videos to be made again, once the daemon has time for it
+		if catchup or backlog > restore_max_backlog:
+			logging.debug('Daemon is busy, not restoring the provisional videos')
+		elif last_run_times['restore_provisional_videos'] + max_run_frequency['restore_provisional_videos'] <= clock.now():
+			last_run_times['restore_provisional_videos'] = clock.now()
+			add_provisional_videos(latest_videos_to_make, daily_videos_to_make)
+		else:
+			logging.debug('Not yet time to run restore_provisional_videos: waiting until %s', last_run_times['restore_provisional_videos'] + max_run_frequency['restore_provisional_videos'])
+		
+		# Apply the retention policies
+		if last_run_times['apply_retention'] + max_run_frequency['apply_retention'] <= clock.now():
+			last_run_times['apply_retention'] = clock.now()
+			retention_process = start_retention(retention_process)
+		else:
+			logging.debug('Not yet time to run apply_retention: waiting until %s', last_run_times['apply_retention'] + max_run_frequency['apply_retention'])
+		
+		# Clean the bad_fitsfiles and decoded_fitsfiles caches
 		bad_fitsfiles.clean(timedelta(hours=time_span))
+		decoded_fitsfiles.clean(timedelta(hours=time_span))
+		
+		# Remove the least recently used files from the scratch directory
+		scratch.clean()
+		
+		# The time taken by the loop is the time the new files wait before their products are made
+		loop_duration = clock.now() - loop_start
 		
 		# Compute the time of the daemon next run
 		next_run_time = min(time + max_run_frequency[name] for name, time in last_run_times.items())
 		logging.debug('Next deamon loop at %s', next_run_time)
 		
 		# If it is not yet time for the next run, we sleep a little
-		while datetime.now() < next_run_time and not stop_daemon.is_set():
-			sleep(1)
+		while clock.now() < next_run_time and not stop_daemon.is_set():
+			clock.sleep(1)
 		
+
+
+if __name__ == '__main__':
+	
+	# You need to force this environment variable, otherwise all child process will be forced to the same CPU
+	os.environ['OPENBLAS_MAIN_FREE'] = '1'
+	
+	# Default name for the log file
+	log_filename = os.path.splitext(sys.argv[0])[0] + '.log'
+	
+	# Get the arguments
+	parser = argparse.ArgumentParser(description='Make AIA latest images and videos')
+	parser.add_argument('--debug', '-d', default=False, action='store_true', help='Set the logging level to debug')
+	parser.add_argument('--verbose', '-v', default=False, action='store_true', help='Set the logging level to info')
+	parser.add_argument('--log_filename', '-l', default=log_filename, help='Overwrite the image if it already exists')
+	parser.add_argument('--time_span', '-t', default=time_span, type=int, help='Duration in hours to go back in time for the creation of images and videos')
+	parser.add_argument('--max_threads', '-m', default=max_threads, type=int, help='Max number of concurrent threads')
+	parser.add_argument('--scratch_directory', '-s', default=scratch_directory, help='Local directory where the intermediate files are made before being published')
+	parser.add_argument('--video_frame_source', '-f', default=video_frame_source, choices=['png', 'raw'], help='Make the video pieces from the png images, or from the raw decoded frames')
+	parser.add_argument('--no_archive_images', '-n', default=False, action='store_true', help='With the raw frame source, do not archive the images')
+
+	# Parse the arguments
+	args = parser.parse_args()
+	
+	if args.debug:
+		log_level = logging.DEBUG
+	elif args.verbose:
+		log_level = logging.INFO
+	else:
+		log_level = logging.ERROR
+	
+	time_span = args.time_span
+	
+	max_threads = args.max_threads
+	
+	scratch_directory = args.scratch_directory
+	
+	video_frame_source = args.video_frame_source
+	
+	archive_images = not args.no_archive_images
+	
+	# Setup the logging
+	logging.basicConfig(level = log_level, filename = args.log_filename, format='%(asctime)s %(levelname)-8s %(funcName)-12s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+	
+	logging.info('Starting deamon')
+	
+	# We setup the termination signal
+	signal.signal(signal.SIGINT, terminate_gracefully)
+	signal.signal(signal.SIGHUP, signal.SIG_IGN)
+	signal.signal(signal.SIGQUIT, terminate_gracefully)
+	signal.signal(signal.SIGTERM, terminate_gracefully)
+	
+	run_daemon()
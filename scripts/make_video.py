@@ -5,12 +5,20 @@ import os
 import string
 import logging
 import argparse
+import threading
+import Queue
 
-from run_command import run_command, run_command_with_input_files
+from run_command import run_command, run_command_with_input_files, start_command_with_input, run_command_with_output
 
 # Path to ffmpeg with libx264 compiled in
 ffmpeg_bin = '/home/sdo/ffmpeg/bin/ffmpeg'
 
+# Path to ffprobe from the same ffmpeg
+ffprobe_bin = '/home/sdo/ffmpeg/bin/ffprobe'
+
+# Profile of the lossless videos, like the video pieces before they are transcoded to compact videos
+lossless_video_profile = 'High 4:4:4 Predictive'
+
 def png_to_mp4_video(input_filenames, output_filename, frame_rate = 24, video_title = None, video_size = None, video_bitrate = None):
 	
 	# We set up ffmpeg for the creation of mp4
@@ -48,7 +56,103 @@ def png_to_ts_video(input_filenames, output_filename, frame_rate = 24, video_tit
 	return run_command_with_input_files(ffmpeg, input_filenames)
 
 
-def video_to_mp4_video(input_filenames, output_filename, frame_rate = 24, video_title = None, video_size = None, video_bitrate = None):
+def raw_to_ts_video_encoder(output_filename, width, height, pixel_format = 'gray', frame_rate = 24, video_title = None, video_preset='ultrafast'):
+	
+	# We set up ffmpeg for the creation of a lossless ts from raw frames (pixel format is gray or rgb24) written progressively to its input
+	ffmpeg = [ffmpeg_bin, '-y', '-f', 'rawvideo', '-pix_fmt', pixel_format, '-s', '%dx%d' % (width, height), '-r', str(frame_rate), '-i', '-', '-an', '-vcodec', 'libx264', '-preset', video_preset, '-qp', '0']
+	
+	# Keep the colors of rgb frames, like for the png frames
+	if pixel_format == 'rgb24':
+		ffmpeg.extend(['-pix_fmt', 'yuv444p'])
+	else:
+		ffmpeg.extend(['-pix_fmt', 'yuv420p'])
+	
+	if video_title:
+		ffmpeg.extend(['-metadata', 'title=' + str(video_title)])
+	
+	ffmpeg.extend(['-f', 'mpegts', output_filename])
+	
+	return start_command_with_input(ffmpeg)
+
+def video_to_ts_video(input_filenames, output_filename):
+	
+	# We set up ffmpeg for the concatenation of videos into a ts without reencoding
+	ffmpeg = [ffmpeg_bin, '-y', '-i']
+	
+	if isinstance(input_filenames, basestring):
+		ffmpeg.append(input_filenames)
+	elif len(input_filenames) == 1:
+		ffmpeg.append(input_filenames[0])
+	else:
+		ffmpeg.append('concat:'+'|'.join(input_filenames))
+	
+	ffmpeg.extend(['-an', '-vcodec', 'copy', '-f', 'mpegts', output_filename])
+	
+	return run_command(ffmpeg)
+
+def video_frames_to_ts_video(input_filename, output_filename, first_frame, last_frame, frame_rate = 24, video_preset='ultrafast'):
+	
+	# We set up ffmpeg for the extraction of a range of frames into a lossless ts, like the video pieces
+	select = "select='between(n,{first_frame},{last_frame})',setpts=N/({frame_rate}*TB)".format(first_frame = first_frame, last_frame = last_frame, frame_rate = frame_rate)
+	ffmpeg = [ffmpeg_bin, '-y', '-i', input_filename, '-an', '-vf', select, '-vsync', 'vfr', '-vcodec', 'libx264', '-preset', video_preset, '-qp', '0', '-f', 'mpegts', output_filename]
+	
+	return run_command(ffmpeg)
+
+def video_select_frames_to_ts_video(input_filenames, output_filename, frame_numbers, frame_rate = 24, video_preset='ultrafast'):
+	
+	# We set up ffmpeg for the extraction of a set of frames of the concatenated videos into a lossless ts, like the video pieces
+	select = "select='{frames}',setpts=N/({frame_rate}*TB)".format(frames = '+'.join('eq(n,%d)' % frame_number for frame_number in frame_numbers), frame_rate = frame_rate)
+	ffmpeg = [ffmpeg_bin, '-y', '-i']
+	
+	if isinstance(input_filenames, basestring):
+		ffmpeg.append(input_filenames)
+	elif len(input_filenames) == 1:
+		ffmpeg.append(input_filenames[0])
+	else:
+		ffmpeg.append('concat:'+'|'.join(input_filenames))
+	
+	ffmpeg.extend(['-an', '-vf', select, '-vsync', 'vfr', '-vcodec', 'libx264', '-preset', video_preset, '-qp', '0', '-f', 'mpegts', output_filename])
+	
+	return run_command(ffmpeg)
+
+def video_frames_to_sprite(input_filename, output_filename, frame_numbers, columns = 6, thumbnail_size = 96):
+	
+	# We set up ffmpeg for the tiling of thumbnails of a set of frames of a video into a single image, row by row
+	columns = min(columns, len(frame_numbers))
+	rows = (len(frame_numbers) + columns - 1) / columns
+	select = "select='{frames}',scale={size}:{size},tile={columns}x{rows}".format(frames = '+'.join('eq(n,%d)' % frame_number for frame_number in frame_numbers), size = thumbnail_size, columns = columns, rows = rows)
+	ffmpeg = [ffmpeg_bin, '-y', '-i', input_filename, '-an', '-vf', select, '-vsync', 'vfr', '-frames:v', '1', '-q:v', '5', output_filename]
+	
+	return run_command(ffmpeg)
+
+def video_to_compact_ts_video(input_filenames, output_filename, video_preset='slow', video_crf=18):
+	
+	# We set up ffmpeg for the reencoding of lossless or mixed videos into a compact lossy ts
+	ffmpeg = [ffmpeg_bin, '-y', '-i']
+	
+	if isinstance(input_filenames, basestring):
+		ffmpeg.append(input_filenames)
+	elif len(input_filenames) == 1:
+		ffmpeg.append(input_filenames[0])
+	else:
+		ffmpeg.append('concat:'+'|'.join(input_filenames))
+	
+	ffmpeg.extend(['-an', '-vcodec', 'libx264', '-preset', video_preset, '-crf', str(video_crf), '-pix_fmt', 'yuv420p', '-f', 'mpegts', output_filename])
+	
+	return run_command(ffmpeg)
+
+def get_video_profile(input_filename):
+	
+	# We set up ffprobe to get the profile of the video stream, like High 4:4:4 Predictive for the lossless videos
+	ffprobe = [ffprobe_bin, '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=profile', '-of', 'default=noprint_wrappers=1:nokey=1', input_filename]
+	
+	output = run_command_with_output(ffprobe)
+	if output is None:
+		return None
+	else:
+		return output.strip()
+
+def video_to_mp4_video(input_filenames, output_filename, frame_rate = 24, video_title = None, video_size = None, video_bitrate = None, video_preset='slow'):
 	
 	# We set up ffmpeg for the creation of mp4
 	ffmpeg = [ffmpeg_bin, '-y', '-i']
@@ -60,7 +164,7 @@ def video_to_mp4_video(input_filenames, output_filename, frame_rate = 24, video_
 	else:
 		ffmpeg.append('concat:'+'|'.join(input_filenames))
 	
-	ffmpeg.extend(['-an', '-vcodec', 'libx264', '-preset', 'slow', '-vprofile', 'baseline', '-pix_fmt', 'yuv420p', '-r', str(frame_rate)])
+	ffmpeg.extend(['-an', '-vcodec', 'libx264', '-preset', video_preset, '-vprofile', 'baseline', '-pix_fmt', 'yuv420p', '-r', str(frame_rate)])
 	
 	if video_bitrate:
 		ffmpeg.extend(['-maxrate', str(video_bitrate) + 'k'])
@@ -75,7 +179,92 @@ def video_to_mp4_video(input_filenames, output_filename, frame_rate = 24, video_
 	
 	return run_command(ffmpeg)
 
-def video_to_webm_video(input_filenames, output_filename, frame_rate = 24, video_title = None, video_size = None, video_bitrate = None):
+def video_to_mp4_video_chunked(input_filenames, output_filename, frame_rate = 24, video_title = None, video_size = None, video_bitrate = None, video_preset='slow', chunk_size = 4, max_workers = 4):
+	'''Make an mp4 video by encoding chunks of chunk_size input videos in parallel with the same parameters, and concatenating them without reencoding'''
+	
+	if isinstance(input_filenames, basestring) or len(input_filenames) <= chunk_size:
+		return video_to_mp4_video(input_filenames, output_filename, frame_rate, video_title, video_size, video_bitrate, video_preset)
+	
+	# Each chunk is encoded by its own ffmpeg, so it starts with a key frame and does not reference frames of the other chunks
+	chunks = [input_filenames[start:start + chunk_size] for start in range(0, len(input_filenames), chunk_size)]
+	chunk_filenames = ['%s.chunk%03d.mp4' % (output_filename, number) for number in range(len(chunks))]
+	chunk_list_filename = output_filename + '.chunks.txt'
+	
+	# The chunks are concatenated into a hidden temporary file, that replaces the video only once its frames are checked
+	temp_filename = os.path.join(os.path.dirname(output_filename), '.' + os.path.basename(output_filename) + '.tmp')
+	
+	input_queue = Queue.Queue()
+	for chunk, chunk_filename in zip(chunks, chunk_filenames):
+		input_queue.put((chunk, chunk_filename))
+	
+	failed_chunks = list()
+	
+	def encode_chunks():
+		while not input_queue.empty():
+			try:
+				chunk, chunk_filename = input_queue.get_nowait()
+			except Queue.Empty:
+				continue
+			if not video_to_mp4_video(chunk, chunk_filename, frame_rate, None, video_size, video_bitrate, video_preset):
+				failed_chunks.append(chunk_filename)
+	
+	threads = [threading.Thread(target=encode_chunks) for worker in range(min(max_workers, len(chunks)))]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	
+	try:
+		if failed_chunks:
+			logging.error('Error while encoding chunks %s of video %s', ', '.join(failed_chunks), output_filename)
+			return False
+		
+		# We set up ffmpeg for the concatenation of the chunks into the mp4 without reencoding
+		write_concat_list(chunk_filenames, chunk_list_filename)
+		
+		ffmpeg = [ffmpeg_bin, '-y', '-f', 'concat', '-safe', '0', '-i', chunk_list_filename, '-an', '-vcodec', 'copy']
+		
+		if video_title:
+			ffmpeg.extend(['-metadata', 'title=' + str(video_title)])
+		
+		ffmpeg.extend(['-f', 'mp4', temp_filename])
+		
+		if not run_command(ffmpeg):
+			return False
+		
+		# The concatenation is seamless only if no frame was lost or duplicated at the boundaries of the chunks
+		chunk_frame_count = sum(get_video_frame_count(chunk_filename) or 0 for chunk_filename in chunk_filenames)
+		frame_count = get_video_frame_count(temp_filename)
+		if frame_count != chunk_frame_count:
+			logging.error('Concatenated video %s has %s frames instead of %s', output_filename, frame_count, chunk_frame_count)
+			return False
+		
+		os.rename(temp_filename, output_filename)
+		return True
+	
+	finally:
+		for filename in chunk_filenames + [chunk_list_filename, temp_filename]:
+			if os.path.exists(filename):
+				os.remove(filename)
+
+def write_concat_list(input_filenames, list_filename):
+	'''Write the list of the input videos for the concat demuxer of ffmpeg'''
+	with open(list_filename, 'w') as list_file:
+		for input_filename in input_filenames:
+			list_file.write("file '%s'\n" % os.path.abspath(input_filename).replace("'", "'\\''"))
+
+def get_video_frame_count(input_filename):
+	
+	# We set up ffprobe to count the frames of the video stream from its packets, without decoding them
+	ffprobe = [ffprobe_bin, '-v', 'error', '-select_streams', 'v:0', '-count_packets', '-show_entries', 'stream=nb_read_packets', '-of', 'default=noprint_wrappers=1:nokey=1', input_filename]
+	
+	output = run_command_with_output(ffprobe)
+	try:
+		return int(output.strip())
+	except (AttributeError, ValueError):
+		return None
+
+def video_to_webm_video(input_filenames, output_filename, frame_rate = 24, video_title = None, video_size = None, video_bitrate = None, cpu_used = 0):
 	
 	# We set up ffmpeg for the creation of webm
 	ffmpeg = [ffmpeg_bin, '-y', '-i']
@@ -87,7 +276,7 @@ def video_to_webm_video(input_filenames, output_filename, frame_rate = 24, video
 	else:
 		ffmpeg.append('concat:'+'|'.join(input_filenames))
 	
-	ffmpeg.extend(['-an', '-vcodec', 'libvpx', '-cpu-used', '0', '-qmin', '10', '-qmax', '42', '-threads', '2', '-r', str(frame_rate)])
+	ffmpeg.extend(['-an', '-vcodec', 'libvpx', '-cpu-used', str(cpu_used), '-qmin', '10', '-qmax', '42', '-threads', '2', '-r', str(frame_rate)])
 	
 	if video_bitrate:
 		ffmpeg.extend(['-maxrate', str(video_bitrate) + 'k'])
@@ -8,6 +8,22 @@ def run_command(command):
 	return run_command_with_input_data(command, input_data = None)
 
 
+def run_command_with_output(command):
+	'''Run a command and return its standard output, or None if it failed'''
+	try:
+		logging.debug("About to execute %s", ' '.join(command))
+		process = subprocess.Popen(command, shell=False, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds = True)
+		stdout, stderr = process.communicate()
+		return_code = process.wait()
+		if return_code != 0:
+			logging.error('Failed running command %s :\n Return code : %d\n StdOut: %s\n StdErr: %s', ' '.join(command), return_code, stdout, stderr)
+			return None
+		return stdout
+	except Exception, why:
+		logging.error('Failed running command %s : %s', ' '.join(command), why)
+		return None
+
+
 def run_command_with_input_data(command, input_data = None):
 	
 	try:
@@ -26,50 +42,73 @@ def run_command_with_input_data(command, input_data = None):
 		return False
 
 
-def run_command_with_input_files(command, input_filenames = []):
-	
-	# We redirect the stdout and stderr to temporary files
-	try:
-		stdout_file = tempfile.TemporaryFile()
-		stderr_file = tempfile.TemporaryFile()
-	except Exception, why:
-		logging.critical('Failed creating temporary files for stout and stderr : %s', why)
-		return False
+class CommandWithInput(object):
+	'''Run a command to which the input is written progressively'''
 	
-	try:
-		logging.debug("About to execute %s", ' '.join(command))
-		process = subprocess.Popen(command, bufsize = 1024 * 1024, shell=False, stdin=subprocess.PIPE, stdout=stdout_file, stderr=stderr_file, close_fds = True)
-		
-		# We write the content of the input files to the stdin of the process
-		for input_filename in input_filenames:
-			try:
-				with open(input_filename, 'rb') as input_file:
-					logging.debug("Writing input file %s to process stdin", input_filename)
-					process.stdin.write(input_file.read())
-			except Exception, why:
-				logging.error("Error writing input file %s to process stdin: %s", input_filename, why)
+	def __init__(self, command):
+		self.command = command
 		
-		process.stdin.close()
-		
-		# We wait for the process to terminate
-		logging.debug("Waiting to terminate process for: %s", ' '.join(command))
-		return_code = process.wait()
+		# We redirect the stdout and stderr to temporary files
+		self.stdout_file = tempfile.TemporaryFile()
+		self.stderr_file = tempfile.TemporaryFile()
 		
-		# Read the stdout and stderr content
-		stdout_file.seek(0)
-		stdout = stdout_file.read()
-		stdout_file.close()
-		stderr_file.seek(0)
-		stderr = stderr_file.read()
-		stderr_file.close()
-		
-		if return_code != 0:
-			logging.error('Failed running command %s :\n Return code : %d\n StdOut: %s\n StdErr: %s', ' '.join(command), return_code, stdout, stderr)
+		logging.debug("About to execute %s", ' '.join(command))
+		self.process = subprocess.Popen(command, bufsize = 1024 * 1024, shell=False, stdin=subprocess.PIPE, stdout=self.stdout_file, stderr=self.stderr_file, close_fds = True)
+	
+	def write(self, input_data):
+		self.process.stdin.write(input_data)
+	
+	def close(self):
+		'''Close the input of the command, wait for it to terminate and return True if it succeeded'''
+		try:
+			self.process.stdin.close()
+			
+			# We wait for the process to terminate
+			logging.debug("Waiting to terminate process for: %s", ' '.join(self.command))
+			return_code = self.process.wait()
+			
+			# Read the stdout and stderr content
+			self.stdout_file.seek(0)
+			stdout = self.stdout_file.read()
+			self.stdout_file.close()
+			self.stderr_file.seek(0)
+			stderr = self.stderr_file.read()
+			self.stderr_file.close()
+			
+			if return_code != 0:
+				logging.error('Failed running command %s :\n Return code : %d\n StdOut: %s\n StdErr: %s', ' '.join(self.command), return_code, stdout, stderr)
+				return False
+			elif logging.root.isEnabledFor(logging.DEBUG):
+				logging.debug('Succeful running command %s :\n Return code : %d\n StdOut: %s\n StdErr: %s', ' '.join(self.command), return_code, stdout, stderr)
+			
+			return True
+		except Exception, why:
+			logging.error('Failed running command %s : %s', ' '.join(self.command), why)
 			return False
-		elif logging.root.isEnabledFor(logging.DEBUG):
-			logging.debug('Succeful running command %s :\n Return code : %d\n StdOut: %s\n StdErr: %s', ' '.join(command), return_code, stdout, stderr)
-		
-		return True
+
+
+def start_command_with_input(command):
+	'''Start a command to which the input can be written progressively, or return None if it could not be started'''
+	try:
+		return CommandWithInput(command)
 	except Exception, why:
 		logging.error('Failed running command %s : %s', ' '.join(command), why)
+		return None
+
+
+def run_command_with_input_files(command, input_filenames = []):
+	
+	process = start_command_with_input(command)
+	if process is None:
 		return False
+	
+	# We write the content of the input files to the stdin of the process
+	for input_filename in input_filenames:
+		try:
+			with open(input_filename, 'rb') as input_file:
+				logging.debug("Writing input file %s to process stdin", input_filename)
+				process.write(input_file.read())
+		except Exception, why:
+			logging.error("Error writing input file %s to process stdin: %s", input_filename, why)
+	
+	return process.close()
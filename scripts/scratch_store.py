@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-15 -*-
+import os, errno, glob
+import logging
+import fnmatch
+import shutil
+import threading
+from datetime import timedelta
+from time import time
+
+class ScratchStore(object):
+	'''Local storage where the intermediate files are made and read back, mirroring the paths of the public storage where the final files are published
+	If the scratch directory is None, all files are made directly in the public storage
+	A file and its sidecars, like the list of the frames of a video, are used and removed together'''
+	
+	def __init__(self, scratch_directory, public_directory, size, hot_age = timedelta(hours = 24), hot_patterns = [], sidecar_suffixes = []):
+		self.scratch_directory = scratch_directory
+		self.public_directory = public_directory
+		self.size = size
+		self.hot_age = hot_age
+		self.hot_patterns = hot_patterns
+		self.sidecar_suffixes = sidecar_suffixes
+		self.lock = threading.Lock()
+		self.pending = set()
+	
+	def local_path(self, public_path):
+		'''Return the path in the scratch storage corresponding to a path in the public storage'''
+		if self.scratch_directory is None:
+			return public_path
+		
+		relative_path = os.path.relpath(public_path, self.public_directory)
+		if relative_path.startswith(os.pardir):
+			return public_path
+		
+		local_path = os.path.join(self.scratch_directory, relative_path)
+		
+		# Keep the trailing separator of directories
+		if public_path.endswith(os.sep):
+			local_path = os.path.join(local_path, '')
+		
+		return local_path
+	
+	def output_path(self, public_path):
+		'''Return the path in the scratch storage where a file is made, the file is kept in the scratch storage until it is published'''
+		local_path = self.local_path(public_path)
+		if local_path != public_path:
+			self.lock.acquire()
+			self.pending.add(self.get_group(local_path))
+			self.lock.release()
+		return local_path
+	
+	def get_group(self, local_path):
+		'''Return the name of the group of a file, that is the file and its sidecars'''
+		for sidecar_suffix in self.sidecar_suffixes:
+			if local_path.endswith(sidecar_suffix):
+				return local_path[:-len(sidecar_suffix)]
+		return os.path.splitext(local_path)[0]
+	
+	def find(self, public_path):
+		'''Return the path of a file in the scratch storage if it is there, else its path in the public storage'''
+		local_path = self.local_path(public_path)
+		if local_path != public_path and os.path.exists(local_path):
+			self.touch(local_path)
+			return local_path
+		else:
+			return public_path
+	
+	def glob(self, public_pattern):
+		'''Return the paths of the files matching a pattern, from the scratch storage when they are there, else from the public storage'''
+		paths = dict((os.path.basename(path), path) for path in glob.glob(public_pattern))
+		
+		local_pattern = self.local_path(public_pattern)
+		if local_pattern != public_pattern:
+			for local_path in glob.glob(local_pattern):
+				self.touch(local_path)
+				paths[os.path.basename(local_path)] = local_path
+		
+		return paths.values()
+	
+	def fetch(self, public_path):
+		'''Return the path of a file in the scratch storage to be modified, copying it from the public storage if necessary'''
+		local_path = self.output_path(public_path)
+		if local_path != public_path and not os.path.exists(local_path) and os.path.exists(public_path):
+			make_directory(os.path.dirname(local_path))
+			shutil.copy(public_path, local_path)
+		return local_path
+	
+	def touch(self, local_path):
+		'''Mark a file as recently used, keeping its modification time'''
+		try:
+			os.utime(local_path, (time(), os.path.getmtime(local_path)))
+		except OSError, why:
+			logging.debug('Could not update the access time of %s: %s', local_path, why)
+	
+	def publish(self, public_paths):
+		'''Copy the files from the scratch storage to the public storage, so that they appear complete at once and are safely on disk'''
+		if self.scratch_directory is None:
+			return True
+		
+		success = True
+		directories = set()
+		published_groups = set()
+		failed_groups = set()
+		
+		for public_path in public_paths:
+			local_path = self.local_path(public_path)
+			if local_path == public_path or not os.path.exists(local_path):
+				continue
+			
+			directory, filename = os.path.split(public_path)
+			temp_path = os.path.join(directory, '.' + filename + '.tmp')
+			logging.debug('Publishing file %s to %s', local_path, public_path)
+			try:
+				make_directory(directory)
+				with open(local_path, 'rb') as local_file, open(temp_path, 'wb') as temp_file:
+					shutil.copyfileobj(local_file, temp_file, 1024 * 1024)
+					temp_file.flush()
+					os.fsync(temp_file.fileno())
+				os.rename(temp_path, public_path)
+			except Exception, why:
+				logging.error('Error publishing file %s to %s: %s', local_path, public_path, why)
+				success = False
+				failed_groups.add(self.get_group(local_path))
+			else:
+				directories.add(directory)
+				published_groups.add(self.get_group(local_path))
+		
+		# The files that were published can be removed from the scratch storage
+		self.lock.acquire()
+		self.pending -= published_groups - failed_groups
+		self.lock.release()
+		
+		# The renames are only safely on disk once the directories are synced
+		for directory in directories:
+			try:
+				directory_fd = os.open(directory, os.O_RDONLY)
+				try:
+					os.fsync(directory_fd)
+				finally:
+					os.close(directory_fd)
+			except OSError, why:
+				logging.warning('Could not sync directory %s: %s', directory, why)
+		
+		return success
+	
+	def is_hot(self, local_path, modification_time, now):
+		'''Hot files are recent files that will be read back soon'''
+		if modification_time + self.hot_age.total_seconds() < now:
+			return False
+		
+		filename = os.path.basename(local_path)
+		return any(fnmatch.fnmatch(filename, hot_pattern) for hot_pattern in self.hot_patterns)
+	
+	def remove(self, public_path):
+		'''Remove a file and its sidecars from the scratch storage, like when the file is removed from the public storage'''
+		local_path = self.local_path(public_path)
+		if local_path == public_path:
+			return
+		
+		for path in [local_path] + [self.get_group(local_path) + sidecar_suffix for sidecar_suffix in self.sidecar_suffixes]:
+			if os.path.exists(path):
+				logging.debug('Removing file %s from scratch', path)
+				try:
+					os.remove(path)
+				except OSError, why:
+					logging.error('Could not remove file %s from scratch: %s', path, why)
+	
+	def clean(self):
+		'''Remove the least recently used files until the scratch storage fits in its size, keeping the hot files and the files not yet published
+		A file and its sidecars are removed together, when none of them was used recently'''
+		if self.scratch_directory is None:
+			return
+		
+		self.lock.acquire()
+		try:
+			now = time()
+			groups = dict()
+			total_size = 0
+			for directory, directory_names, filenames in os.walk(self.scratch_directory):
+				for filename in filenames:
+					local_path = os.path.join(directory, filename)
+					try:
+						stat = os.stat(local_path)
+					except OSError:
+						continue
+					total_size += stat.st_size
+					access_time, size, hot, paths = groups.get(self.get_group(local_path), (0, 0, False, []))
+					groups[self.get_group(local_path)] = (max(access_time, stat.st_atime), size + stat.st_size, hot or self.is_hot(local_path, stat.st_mtime, now), paths + [local_path])
+			
+			for access_time, size, group, paths in sorted((access_time, size, group, paths) for group, (access_time, size, hot, paths) in groups.iteritems() if not hot and group not in self.pending):
+				if total_size <= self.size:
+					break
+				
+				for local_path in paths:
+					logging.debug('Removing file %s from scratch', local_path)
+					try:
+						os.remove(local_path)
+					except OSError, why:
+						logging.error('Could not remove file %s from scratch: %s', local_path, why)
+				total_size -= size
+		finally:
+			self.lock.release()
+
+
+def make_directory(directory):
+	'''Create a directory and all the subdirectories'''
+	try:
+		os.makedirs(directory)
+	except OSError, why:
+		if why.errno != errno.EEXIST:
+			raise
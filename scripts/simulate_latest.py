@@ -0,0 +1,389 @@
+#!/usr/bin/python
+# -*- coding: iso-8859-15 -*-
+'''
+Replay a timeline of arrivals of AIA quicklook fits files on an accelerated clock, run the daemon of the sdodata latest website on a temporary tree with stand-ins of the tools, and report the publish latency and the backlog per product
+'''
+
+import sys, os, re
+import errno
+import shutil
+import tempfile
+import logging
+import argparse
+import threading
+from datetime import datetime, timedelta
+from dateutil.parser import parse as parse_date
+import numpy
+
+import make_latest_videos_and_images as daemon
+from daemon_clock import AcceleratedClock
+
+# Name of the simulated fits files
+fitsfile_pattern = 'AIA.{date.year:04d}{date.month:02d}{date.day:02d}_{date.hour:02d}{date.minute:02d}{date.second:02d}.{wavelength:04d}.quicklook.fits'
+
+# Simulated duration in seconds of the tools: a fixed duration, and a duration per input (image, frame or video piece)
+tool_durations = {
+	'get_keywords': (0.005, 0.),
+	'read_frame': (0.5, 0.),
+	'fits_to_png': (2., 0.),
+	'raw_to_png': (0.5, 0.),
+	'raw_to_formats': (0.8, 0.),
+	'image_to_formats': (0.5, 0.),
+	'png_to_ts_video': (1., 0.5),
+	'raw_to_ts_video_encoder': (1., 0.1),
+	'video_to_mp4_video': (5., 20.),
+	'video_select_frames_to_ts_video': (2., 5.),
+	'video_frames_to_ts_video': (2., 0.),
+	'video_frames_to_sprite': (2., 0.),
+}
+
+# Speed of the encoder presets relative to the slow preset
+preset_speeds = {
+	'slow': 1.,
+	'veryfast': 0.3,
+	'ultrafast': 0.1,
+}
+
+# Size of the frames returned by the stand-in of read_frame
+frame_size = 64
+
+# If True, the concatenated chunks of the mp4 videos fail the check of their frame count, like when frames are lost at the boundaries of the chunks
+fail_concat = False
+
+def touch(path):
+	'''Create an empty file and its directory'''
+	try:
+		os.makedirs(os.path.dirname(path))
+	except OSError, why:
+		if why.errno != errno.EEXIST:
+			raise
+	open(path, 'w').close()
+
+def get_fitsfile_wavelength(fitsfile):
+	'''Return the wavelength of a fits file from its name'''
+	return int(re.search(r'\.(\d{4})\.quicklook\.fits$', fitsfile).group(1))
+
+def read_timeline(filename):
+	'''Return the list of (arrival date, fits file name) of a recorded timeline, with one line per fits file like "2016-10-19T13:20:04 AIA.20161019_131502.0171.quicklook.fits"'''
+	timeline = list()
+	with open(filename) as timeline_file:
+		for line in timeline_file:
+			if line.strip() and not line.startswith('#'):
+				arrival, fitsfile = line.split()
+				timeline.append((parse_date(arrival).replace(tzinfo = None), os.path.basename(fitsfile)))
+	return sorted(timeline)
+
+def make_timeline(start, end, cadences, arrival_delay, gaps):
+	'''Return the list of (arrival date, fits file name) of fits files taken at the cadence of each wavelength and arriving after the arrival delay, the files that would arrive during a gap arrive all at its end'''
+	timeline = list()
+	for wavelength, cadence in cadences.iteritems():
+		date = start
+		while date < end:
+			arrival = date + arrival_delay
+			for gap_start, gap_end in gaps:
+				if gap_start <= arrival < gap_end:
+					arrival = gap_end
+			timeline.append((arrival, fitsfile_pattern.format(date = date, wavelength = wavelength)))
+			date += cadence
+	return sorted(timeline)
+
+
+class Recorder(object):
+	'''Record the arrival of the fits files, the publication of the products and the backlog of the daemon'''
+	
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.arrivals = dict()
+		self.images = set()
+		self.latencies = dict()
+		self.published = dict()
+		self.samples = list()
+	
+	def arrived(self, date, arrival):
+		self.lock.acquire()
+		self.arrivals[date] = max(arrival, self.arrivals.get(date, arrival))
+		self.lock.release()
+	
+	def published_frames(self, kind, product, dates, publish_date):
+		'''Record the latency of the frames of a product that are published for the first time'''
+		self.lock.acquire()
+		try:
+			published = self.published.setdefault((kind, product), set())
+			latencies = self.latencies.setdefault((kind, product), list())
+			for date in dates:
+				if date in self.arrivals and date not in published:
+					published.add(date)
+					latencies.append(publish_date - self.arrivals[date])
+		finally:
+			self.lock.release()
+	
+	def made_image(self, wavelength, date):
+		self.lock.acquire()
+		self.images.add((wavelength, date))
+		self.lock.release()
+	
+	def sample(self, date, arrived, catchup):
+		'''Record the number of fits files arrived without image yet'''
+		self.lock.acquire()
+		self.samples.append((date, arrived - len(self.images), catchup))
+		self.lock.release()
+	
+	def print_report(self, timeline):
+		print 'Publish latency in minutes, from the arrival of the fits files'
+		print '%-24s %-14s %8s %8s %8s %8s %8s' % ('product', 'kind', 'count', 'mean', 'median', 'p95', 'max')
+		for (kind, product), latencies in sorted(self.latencies.iteritems(), key = lambda item: (str(item[0][1]), item[0][0])):
+			if not latencies:
+				continue
+			minutes = sorted(latency.total_seconds() / 60. for latency in latencies)
+			print '%-24s %-14s %8d %8.1f %8.1f %8.1f %8.1f' % (product, kind, len(minutes), sum(minutes) / len(minutes), minutes[len(minutes) / 2], minutes[int(0.95 * (len(minutes) - 1))], minutes[-1])
+		
+		print
+		print 'Backlog of fits files arrived without image, per hour'
+		print '%-20s %8s %12s %10s' % ('hour', 'arrived', 'max backlog', 'catch up')
+		hours = dict()
+		for date, backlog, catchup in self.samples:
+			hour = daemon.round_to_hour(date)
+			max_backlog, any_catchup = hours.get(hour, (0, False))
+			hours[hour] = (max(max_backlog, backlog), any_catchup or catchup)
+		for hour in sorted(hours):
+			arrived = sum(1 for arrival, fitsfile in timeline if daemon.round_to_hour(arrival) == hour)
+			max_backlog, any_catchup = hours[hour]
+			print '%-20s %8d %12d %10s' % (hour.strftime('%Y-%m-%d %H:%M'), arrived, max_backlog, 'yes' if any_catchup else '')
+
+
+class StandInEncoder(object):
+	'''Stand-in of the encoder of the raw frames'''
+	
+	def __init__(self, output_filename, video_preset):
+		self.output_filename = output_filename
+		self.video_preset = video_preset
+		self.frames = 0
+	
+	def write(self, input_data):
+		self.frames += 1
+	
+	def close(self):
+		work('raw_to_ts_video_encoder', self.frames, preset_speeds[self.video_preset])
+		touch(self.output_filename)
+		return True
+
+
+def work(tool, inputs = 0, speed = 1.):
+	'''Wait for the simulated duration of a tool'''
+	fixed_duration, input_duration = tool_durations[tool]
+	clock.sleep((fixed_duration + input_duration * inputs) * speed)
+
+def get_keywords(fitsfile, keywords):
+	work('get_keywords')
+	date = daemon.get_frame_date(os.path.basename(fitsfile))
+	return {'DATE-OBS': date.isoformat(), 'WAVELNTH': get_fitsfile_wavelength(fitsfile), 'QUALITY': 0}
+
+def read_frame(fitsfile):
+	work('read_frame')
+	return numpy.zeros((frame_size, frame_size), dtype = numpy.int16), {'EXPTIME': 1.}
+
+def fits_to_png(fitsfile, output_directory, *args, **kwargs):
+	work('fits_to_png')
+	touch(os.path.join(output_directory, os.path.splitext(os.path.basename(fitsfile))[0] + '.png'))
+	return True
+
+def raw_to_png(input_data, width, height, output_filename, *args, **kwargs):
+	work('raw_to_png')
+	touch(output_filename)
+	return True
+
+def raw_to_formats(input_data, width, height, output_filenames, *args, **kwargs):
+	work('raw_to_formats')
+	for output_filename in output_filenames:
+		touch(output_filename)
+	return True
+
+def image_to_formats(input_filename, output_filenames, *args, **kwargs):
+	work('image_to_formats')
+	for output_filename in output_filenames:
+		touch(output_filename)
+	return True
+
+def png_to_ts_video(input_filenames, output_filename, video_preset = 'ultrafast', *args, **kwargs):
+	work('png_to_ts_video', len(input_filenames), preset_speeds[video_preset])
+	touch(output_filename)
+	return True
+
+def raw_to_ts_video_encoder(output_filename, *args, **kwargs):
+	return StandInEncoder(output_filename, kwargs.get('video_preset', 'ultrafast'))
+
+def video_to_mp4_video_chunked(input_filenames, output_filename, frame_rate = 24, video_title = None, video_size = None, video_bitrate = None, video_preset = 'slow', chunk_size = 4, max_workers = 4):
+	# The chunks are encoded in parallel
+	workers = max(1, min(max_workers, (len(input_filenames) + chunk_size - 1) / chunk_size))
+	work('video_to_mp4_video', float(len(input_filenames)) / workers, preset_speeds[video_preset])
+	
+	# Like the real one, the chunks are concatenated into a temporary file that replaces the video only if its frames are checked
+	if len(input_filenames) > chunk_size:
+		temp_filename = os.path.join(os.path.dirname(output_filename), '.' + os.path.basename(output_filename) + '.tmp')
+		touch(temp_filename)
+		if fail_concat:
+			logging.error('Concatenated video %s has not the frames of its chunks', output_filename)
+			os.remove(temp_filename)
+			return False
+		os.rename(temp_filename, output_filename)
+	else:
+		touch(output_filename)
+	
+	# The latency of the latest videos is the time until the frames of their video pieces are published
+	if '.latest.' in os.path.basename(output_filename):
+		dates = list()
+		for input_filename in input_filenames:
+			dates.extend(daemon.get_frame_date(frame) for frame in daemon.read_video_piece_frames(input_filename) or [])
+		recorder.published_frames('latest video', os.path.basename(output_filename).split('.')[2], dates, clock.utcnow())
+	
+	return True
+
+def video_select_frames_to_ts_video(input_filenames, output_filename, frame_numbers, *args, **kwargs):
+	work('video_select_frames_to_ts_video', len(input_filenames))
+	touch(output_filename)
+	return True
+
+def video_frames_to_ts_video(input_filename, output_filename, *args, **kwargs):
+	work('video_frames_to_ts_video')
+	touch(output_filename)
+	return True
+
+def video_frames_to_sprite(input_filename, output_filename, *args, **kwargs):
+	work('video_frames_to_sprite')
+	touch(output_filename)
+	return True
+
+def start_retention(retention_process):
+	return None
+
+def make_images():
+	'''Make the images like the daemon, and record their latency'''
+	images, fitsfiles_backlog = daemon_make_images()
+	for image in images:
+		recorder.published_frames('image', '{wavelength:04d}'.format(wavelength = image['wavelength']), [image['date']], clock.utcnow())
+		if image['wavelength'] in daemon.AIA_wavelengths:
+			recorder.made_image(image['wavelength'], image['date'])
+	return images, fitsfiles_backlog
+
+def thread_replay(timeline, end, sample_interval):
+	'''Drop the fits files in the fits files directory when they arrive, and stop the daemon at the end of the simulation'''
+	arrived = 0
+	last_sample = None
+	
+	while not daemon.stop_daemon.is_set():
+		now = clock.utcnow()
+		
+		while arrived < len(timeline) and timeline[arrived][0] <= now:
+			arrival, fitsfile = timeline[arrived]
+			date = daemon.get_frame_date(fitsfile)
+			touch(os.path.join(daemon.fitsfiles_directory.format(date = date, wavelength = get_fitsfile_wavelength(fitsfile)), fitsfile))
+			recorder.arrived(date, arrival)
+			arrived += 1
+		
+		if last_sample is None or now >= last_sample + sample_interval:
+			last_sample = now
+			recorder.sample(now, arrived, getattr(daemon, 'catchup', False))
+		
+		if now >= end:
+			logging.info('End of the simulation at %s', now)
+			daemon.stop_daemon.set()
+		else:
+			clock.sleep(10)
+
+
+class SimulatedTimeFormatter(logging.Formatter):
+	'''Log with the simulated time'''
+	
+	def formatTime(self, record, datefmt = None):
+		return clock.utcnow().strftime(datefmt or '%Y-%m-%d %H:%M:%S')
+
+
+if __name__ == '__main__':
+	
+	# Default name for the log file
+	log_filename = os.path.splitext(sys.argv[0])[0] + '.log'
+	
+	# Get the arguments
+	parser = argparse.ArgumentParser(description='Simulate the daemon making the AIA latest images and videos, on an accelerated clock')
+	parser.add_argument('--debug', '-d', default=False, action='store_true', help='Set the logging level to debug')
+	parser.add_argument('--verbose', '-v', default=False, action='store_true', help='Set the logging level to info')
+	parser.add_argument('--log_filename', '-l', default=log_filename, help='The path of the log file')
+	parser.add_argument('--timeline', '-T', default=None, help='A recorded timeline of arrivals, with one line per fits file like "2016-10-19T13:20:04 AIA.20161019_131502.0171.quicklook.fits", instead of a synthetic one')
+	parser.add_argument('--start', '-S', default=None, help='Start date of the synthetic timeline (default: 2 days ago)')
+	parser.add_argument('--duration', '-D', default=24, type=float, help='Duration in hours of the simulation')
+	parser.add_argument('--speedup', '-x', default=30, type=float, help='How many times faster than the real time the simulated clock runs. The daemon own work is accelerated as well, so keep it low enough')
+	parser.add_argument('--cadence', '-c', default=60, type=float, help='Cadence in seconds of the synthetic fits files, 4500 having a cadence of an hour')
+	parser.add_argument('--arrival_delay', '-a', default=5, type=float, help='Delay in minutes between the observation and the arrival of the synthetic fits files')
+	parser.add_argument('--gap', '-g', default=[], nargs=2, action='append', metavar=('START', 'HOURS'), help='A gap in the arrival of the synthetic fits files, that all arrive at its end')
+	parser.add_argument('--video_frame_source', '-f', default=daemon.video_frame_source, choices=['png', 'raw'], help='Make the video pieces from the png images, or from the raw decoded frames')
+	parser.add_argument('--max_threads', '-m', default=daemon.max_threads, type=int, help='Max number of concurrent threads')
+	parser.add_argument('--fail_concat', '-F', default=False, action='store_true', help='Make the concatenation of the chunks of the mp4 videos fail, to check that the failed videos are not published')
+	parser.add_argument('--keep_tree', '-k', default=False, action='store_true', help='Do not remove the temporary tree at the end of the simulation')
+	
+	# Parse the arguments
+	args = parser.parse_args()
+	
+	if args.debug:
+		log_level = logging.DEBUG
+	elif args.verbose:
+		log_level = logging.INFO
+	else:
+		log_level = logging.ERROR
+	
+	# Make the timeline of the arrivals of the fits files
+	if args.timeline:
+		timeline = read_timeline(args.timeline)
+		if not timeline:
+			sys.exit('Timeline %s is empty' % args.timeline)
+		start = daemon.round_to_hour(timeline[0][0])
+	else:
+		start = parse_date(args.start) if args.start else daemon.round_to_hour(datetime.utcnow()) - timedelta(days = 2)
+		cadences = dict.fromkeys(daemon.AIA_wavelengths, timedelta(seconds = args.cadence))
+		cadences[4500] = timedelta(hours = 1)
+		gaps = [(parse_date(gap_start), parse_date(gap_start) + timedelta(hours = float(hours))) for gap_start, hours in args.gap]
+		timeline = make_timeline(start, start + timedelta(hours = args.duration), cadences, timedelta(minutes = args.arrival_delay), gaps)
+	
+	end = start + timedelta(hours = args.duration)
+	
+	clock = AcceleratedClock(start, args.speedup)
+	fail_concat = args.fail_concat
+	recorder = Recorder()
+	
+	# Setup the logging, with the simulated time
+	log_handler = logging.FileHandler(args.log_filename)
+	log_handler.setFormatter(SimulatedTimeFormatter('%(asctime)s %(levelname)-8s %(funcName)-12s %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+	logging.root.addHandler(log_handler)
+	logging.root.setLevel(log_level)
+	
+	# All the files of the daemon are made in a temporary tree
+	tree = tempfile.mkdtemp(prefix = 'simulate_latest_')
+	for name, value in vars(daemon).items():
+		if isinstance(value, basestring) and value.startswith('/data/SDO/public/'):
+			setattr(daemon, name, os.path.join(tree, value[len('/data/SDO/public/'):]))
+	daemon.scratch_directory = None
+	
+	daemon.clock = clock
+	daemon.video_frame_source = args.video_frame_source
+	daemon.max_threads = args.max_threads
+	
+	# The tools are replaced by stand-ins that only wait for their simulated duration
+	for stand_in in [get_keywords, read_frame, fits_to_png, raw_to_png, raw_to_formats, image_to_formats, png_to_ts_video, raw_to_ts_video_encoder, video_to_mp4_video_chunked, video_select_frames_to_ts_video, video_frames_to_ts_video, video_frames_to_sprite, start_retention]:
+		setattr(daemon, stand_in.__name__, stand_in)
+	daemon_make_images = daemon.make_images
+	daemon.make_images = make_images
+	
+	logging.info('Simulating %d fits files from %s to %s in %s', len(timeline), start, end, tree)
+	
+	replay = threading.Thread(target = thread_replay, args = (timeline, end, timedelta(minutes = 1)))
+	replay.daemon = True
+	replay.start()
+	
+	try:
+		daemon.run_daemon()
+	except KeyboardInterrupt:
+		daemon.stop_daemon.set()
+	finally:
+		if not args.keep_tree:
+			shutil.rmtree(tree, ignore_errors = True)
+	
+	recorder.print_report(timeline)
@@ -0,0 +1,59 @@
+/* Show a preview of the frame under the mouse when hovering the bottom of the video, from the sprites of the thumbnails track */
+(function() {
+	var video = document.querySelector('#content video');
+	var track = video ? video.querySelector('track[label="thumbnails"]') : null;
+
+	if (!track || !track.track) {
+		return;
+	}
+
+	// The cues of a metadata track are only loaded if the track is not disabled
+	track.track.mode = 'hidden';
+
+	var preview = document.createElement('div');
+	preview.id = 'preview';
+	video.parentNode.appendChild(preview);
+
+	function hide_preview() {
+		preview.style.display = 'none';
+	}
+
+	function get_thumbnail(time) {
+		var cues = track.track.cues;
+		if (cues) {
+			for (var i = 0; i < cues.length; i++) {
+				if (cues[i].startTime <= time && time < cues[i].endTime) {
+					return /^(.*)#xywh=(\d+),(\d+),(\d+),(\d+)$/.exec(cues[i].text);
+				}
+			}
+		}
+		return null;
+	}
+
+	video.addEventListener('mousemove', function(event) {
+		var rect = video.getBoundingClientRect();
+
+		// The previews are only shown over the controls, at the bottom of the video
+		if (!video.duration || event.clientY < rect.bottom - 40) {
+			hide_preview();
+			return;
+		}
+
+		var thumbnail = get_thumbnail((event.clientX - rect.left) / rect.width * video.duration);
+		if (!thumbnail) {
+			hide_preview();
+			return;
+		}
+
+		var width = parseInt(thumbnail[4]), height = parseInt(thumbnail[5]);
+		preview.style.backgroundImage = 'url(' + thumbnail[1] + ')';
+		preview.style.backgroundPosition = '-' + thumbnail[2] + 'px -' + thumbnail[3] + 'px';
+		preview.style.width = width + 'px';
+		preview.style.height = height + 'px';
+		preview.style.left = (video.offsetLeft + event.clientX - rect.left - width / 2) + 'px';
+		preview.style.top = (video.offsetTop + video.offsetHeight - 50 - height) + 'px';
+		preview.style.display = 'block';
+	});
+
+	video.addEventListener('mouseleave', hide_preview);
+})();